@@ -0,0 +1,3 @@
+"""
+Director benchmarks running against in-process fake Docker Engine
+"""
@@ -0,0 +1,319 @@
+"""
+Fake Docker Engine API served by aiohttp on unix socket.
+Implements subset used by director: containers list/inspect/create/start/stop/
+restart/delete, events, multiplexed logs, stats, image build and inspect.
+Each request can be delayed to simulate daemon latency.
+"""
+import asyncio
+import os
+import struct
+import ujson
+from hashlib import sha256
+from itertools import count
+from time import time
+from aiohttp import web
+
+DOCKER_TIME = '%Y-%m-%dT%H:%M:%S.000000000Z'
+
+
+def docker_time(ts):
+    from datetime import datetime
+    return datetime.utcfromtimestamp(ts).strftime(DOCKER_TIME)
+
+
+def make_id(seed):
+    return sha256(str(seed).encode()).hexdigest()
+
+
+def log_frame(line, stream=1):
+    """
+    Docker multiplexed stream frame: 8 bytes header then payload
+    """
+    payload = line.encode()
+    return struct.pack('>BxxxL', stream, len(payload)) + payload
+
+
+class FakeContainer:
+    def __init__(self, cid, name, image, labels=None, port_bindings=None, running=False):
+        self.id = cid
+        self.name = name
+        self.image = image
+        self.labels = labels or {}
+        self.port_bindings = port_bindings or {}
+        self.running = running
+        self.created = int(time())
+        self.started_at = time() if running else None
+
+    @property
+    def status(self):
+        return 'running' if self.running else 'exited'
+
+    def host_ports(self):
+        return [int(b['HostPort']) for binds in self.port_bindings.values() for b in binds]
+
+    def list_struct(self):
+        return {
+            'Id': self.id,
+            'Names': [f'/{self.name}'],
+            'Image': self.image,
+            'ImageID': self.image,
+            'Created': self.created,
+            'Labels': self.labels,
+            'State': self.status,
+            'Status': self.status,
+            'Ports': [{'PrivatePort': int(p.split('/')[0]), 'PublicPort': hp, 'Type': 'tcp'}
+                      for p, hp in zip(self.port_bindings, self.host_ports())] if self.running else [],
+            'HostConfig': {'NetworkMode': 'custom'}
+        }
+
+    def inspect_struct(self):
+        return {
+            'Id': self.id,
+            'Name': f'/{self.name}',
+            'Image': self.image,
+            'Created': docker_time(self.created),
+            'State': {
+                'Status': self.status,
+                'Running': self.running,
+                'StartedAt': docker_time(self.started_at or 0),
+            },
+            'Config': {'Labels': self.labels, 'Image': self.image},
+            'HostConfig': {'PortBindings': self.port_bindings, 'AutoRemove': False},
+        }
+
+
+class FakeDocker:
+    """
+    Keeps fake daemon state and serves API.
+    latency - seconds added to every request,
+    log_lines - lines emitted by logs endpoint before stream closed (None for endless),
+    log_rate - lines per second for endless logs streams,
+    log_line_size - payload size of log line
+    """
+
+    def __init__(self, latency=0, build_steps=3, log_lines=None, log_rate=10, log_line_size=120):
+        self.latency = latency
+        self.build_steps = build_steps
+        self.log_lines = log_lines
+        self.log_rate = log_rate
+        self.log_line_size = log_line_size
+        self.containers = dict()
+        self.images = dict()
+        self.events = []
+        self.requests = 0
+        self._ids = count()
+        self.runner = None
+
+    """
+    State helpers
+    """
+
+    def add_container(self, name, labels=None, running=True, ports=('8080/tcp',), host_port=None):
+        cid = make_id(f'c{next(self._ids)}')
+        host_port = host_port or 8900 + len(self.containers)
+        bindings = {p: [{'HostIp': '127.0.0.1', 'HostPort': str(host_port)}] for p in ports}
+        container = FakeContainer(cid, name, make_id(name), labels=labels or {'inband': 'native'},
+                                  port_bindings=bindings, running=running)
+        self.containers[cid] = container
+        return container
+
+    def populate(self, amount, prefix='svc'):
+        for i in range(amount):
+            self.add_container(f'{prefix}{i}', host_port=10000 + i)
+
+    def add_image(self, name, ports=('8080/tcp',)):
+        image_id = 'sha256:' + make_id(f'{name}{next(self._ids)}')
+        self.images[name] = {
+            'Id': image_id,
+            'RepoTags': [name],
+            'Config': {'Cmd': ['python', '-m', 'service'], 'Labels': {}},
+            'ContainerConfig': {'ExposedPorts': {p: {} for p in ports}},
+        }
+        return image_id
+
+    def find(self, ref):
+        if ref in self.containers:
+            return self.containers[ref]
+        for c in self.containers.values():
+            if c.name == ref or c.id.startswith(ref):
+                return c
+
+    def emit(self, action, container):
+        event = {
+            'Type': 'container', 'Action': action, 'status': action, 'id': container.id,
+            'Actor': {'ID': container.id, 'Attributes': dict(container.labels, name=container.name)},
+            'time': int(time()), 'timeNano': int(time() * 1e9)}
+        for queue in self.events:
+            queue.put_nowait(event)
+
+    """
+    API handlers
+    """
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    def json(self, data, status=200):
+        return web.json_response(data, status=status, dumps=ujson.dumps)
+
+    def not_found(self, ref):
+        return self.json({'message': f'No such container: {ref}'}, status=404)
+
+    async def containers_list(self, request):
+        filters = ujson.loads(request.query.get('filters') or '{}')
+        show_all = request.query.get('all') in ('1', 'true', 'True')
+        result = []
+        for c in self.containers.values():
+            if not show_all and not c.running:
+                continue
+            if 'label' in filters and not all(l in c.labels for l in filters['label']):
+                continue
+            if 'status' in filters and c.status not in filters['status']:
+                continue
+            result.append(c.list_struct())
+        return self.json(result)
+
+    async def container_inspect(self, request):
+        c = self.find(request.match_info['ref'])
+        if not c:
+            return self.not_found(request.match_info['ref'])
+        return self.json(c.inspect_struct())
+
+    async def container_create(self, request):
+        config = await request.json()
+        name = request.query.get('name')
+        if self.find(name):
+            return self.json({'message': 'Conflict'}, status=409)
+        c = self.add_container(name, labels=config.get('Labels'), running=False)
+        c.port_bindings = config.get('HostConfig', {}).get('PortBindings', {})
+        c.image = config.get('Image')
+        return self.json({'Id': c.id, 'Warnings': []}, status=201)
+
+    async def container_action(self, request):
+        c = self.find(request.match_info['ref'])
+        if not c:
+            return self.not_found(request.match_info['ref'])
+        action = request.match_info['action']
+        if action in ('start', 'restart'):
+            c.running = True
+            c.started_at = time()
+            self.emit('start', c)
+        elif action == 'stop':
+            c.running = False
+            self.emit('stop', c)
+        return web.Response(status=204)
+
+    async def container_delete(self, request):
+        c = self.find(request.match_info['ref'])
+        if not c:
+            return self.not_found(request.match_info['ref'])
+        del self.containers[c.id]
+        self.emit('destroy', c)
+        return web.Response(status=204)
+
+    async def stream(self, request):
+        response = web.StreamResponse()
+        response.content_type = 'application/json'
+        await response.prepare(request)
+        return response
+
+    async def events_stream(self, request):
+        response = await self.stream(request)
+        queue = asyncio.Queue()
+        self.events.append(queue)
+        try:
+            while True:
+                event = await queue.get()
+                await response.write(ujson.dumps(event).encode() + b'\n')
+        finally:
+            self.events.remove(queue)
+
+    async def logs_stream(self, request):
+        c = self.find(request.match_info['ref'])
+        if not c:
+            return self.not_found(request.match_info['ref'])
+        response = web.StreamResponse()
+        response.content_type = 'application/vnd.docker.raw-stream'
+        await response.prepare(request)
+        line = 'x' * max(self.log_line_size - 1, 0) + '\n'
+        if self.log_lines is not None:
+            frame = log_frame(line)
+            batch = frame * 100
+            sent = 0
+            while sent < self.log_lines:
+                amount = min(100, self.log_lines - sent)
+                await response.write(batch if amount == 100 else frame * amount)
+                sent += amount
+            await response.write_eof()
+            return response
+        while True:
+            await response.write(log_frame(line))
+            await asyncio.sleep(1 / self.log_rate)
+
+    async def stats_stream(self, request):
+        response = await self.stream(request)
+        while True:
+            await response.write(ujson.dumps({
+                'read': docker_time(time()),
+                'cpu_stats': {'cpu_usage': {'total_usage': 0}},
+                'memory_stats': {'usage': 0, 'limit': 0}}).encode() + b'\n')
+            if request.query.get('stream') in ('0', 'false'):
+                return response
+            await asyncio.sleep(1)
+
+    async def image_build(self, request):
+        name = request.query.get('t')
+        # consuming build context
+        await request.read()
+        response = await self.stream(request)
+        for step in range(1, self.build_steps + 1):
+            await response.write(ujson.dumps(
+                {'stream': f'Step {step}/{self.build_steps} : RUN true\n'}).encode() + b'\n')
+        image_id = self.add_image(name)
+        await response.write(ujson.dumps({'aux': {'ID': image_id}}).encode() + b'\n')
+        await response.write(ujson.dumps(
+            {'stream': f'Successfully built {image_id[7:19]}\n'}).encode() + b'\n')
+        return response
+
+    async def image_inspect(self, request):
+        name = request.match_info['name']
+        image = self.images.get(name)
+        if not image:
+            return self.json({'message': f'No such image: {name}'}, status=404)
+        return self.json(image)
+
+    def app(self):
+        app = web.Application(middlewares=[self.middleware])
+        routes = [
+            ('GET', '/containers/json', self.containers_list),
+            ('GET', '/containers/{ref}/json', self.container_inspect),
+            ('GET', '/containers/{ref}/logs', self.logs_stream),
+            ('GET', '/containers/{ref}/stats', self.stats_stream),
+            ('POST', '/containers/create', self.container_create),
+            ('POST', '/containers/{ref}/{action}', self.container_action),
+            ('DELETE', '/containers/{ref}', self.container_delete),
+            ('GET', '/events', self.events_stream),
+            ('POST', '/build', self.image_build),
+            ('GET', '/images/{name:.+}/json', self.image_inspect),
+        ]
+        for method, path, handler in routes:
+            # clients may prefix path with api version
+            app.router.add_route(method, path, handler)
+            app.router.add_route(method, r'/{version:v[\d.]+}' + path, handler)
+        return app
+
+    async def start(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.runner = web.AppRunner(self.app())
+        await self.runner.setup()
+        await web.UnixSite(self.runner, path).start()
+        return f'unix://{path}'
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
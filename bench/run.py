@@ -0,0 +1,200 @@
+"""
+Director benchmarks against fake Docker Engine.
+
+Usage:
+    python -m bench.run --output results.json [--compare previous.json] [--latency 0.001]
+
+Measures resolve_docstatus_all cycle cost, run_container overhead,
+log ingest lines/sec and /list snapshot latency at 10/100/1000 containers.
+"""
+import argparse
+import asyncio
+import os
+import platform
+import tempfile
+import ujson
+from time import perf_counter, time
+
+from .fake_docker import FakeDocker
+
+SOCKET = os.path.join(tempfile.gettempdir(), 'director-fake-docker.sock')
+SIZES = (10, 100, 1000)
+
+
+def summary(samples):
+    samples = sorted(samples)
+    return dict(
+        rounds=len(samples),
+        min=samples[0],
+        median=samples[len(samples) // 2],
+        p95=samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        max=samples[-1])
+
+
+async def measure(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        started = perf_counter()
+        await fn()
+        samples.append(perf_counter() - started)
+    return summary(samples)
+
+
+def measure_sync(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        started = perf_counter()
+        fn()
+        samples.append(perf_counter() - started)
+    return summary(samples)
+
+
+def fill_state(state, fake):
+    """
+    Registers fake containers at state skipping config loading from redis
+    """
+    from director.state.service import ServiceState
+    state.state.clear()
+    for c in fake.containers.values():
+        svc = ServiceState(manager=state, name=c.name)
+        svc.set_loaded()
+        state.state[c.name] = svc
+
+
+async def bench_resolve(fake, state, rounds):
+    results = dict()
+    for size in SIZES:
+        fake.containers.clear()
+        fake.populate(size)
+        fill_state(state, fake)
+        results[str(size)] = await measure(state.resolve_docstatus_all, rounds)
+    return results
+
+
+async def bench_list(fake, state, rounds):
+    results = dict()
+    for size in SIZES:
+        fake.containers.clear()
+        fake.populate(size)
+        fill_state(state, fake)
+        await state.resolve_docstatus_all()
+        services = list(state.values())
+
+        def cold():
+            # any mutation invalidates snapshot
+            state.touch(services[0])
+            state.list_snapshot()
+
+        results[str(size)] = dict(
+            cold=measure_sync(cold, rounds),
+            warm=measure_sync(state.list_snapshot, rounds * 10))
+    return results
+
+
+def image_source(path):
+    with open(os.path.join(path, 'Dockerfile'), 'w') as f:
+        f.write('FROM scratch\nCMD ["true"]\n')
+    with open(os.path.join(path, '.dockerignore'), 'w') as f:
+        f.write('.git\n')
+
+
+async def bench_run_container(fake, dock, image_navigator, rounds):
+    from director.band_image import BandImage
+    fake.containers.clear()
+    fake.populate(10)
+    with tempfile.TemporaryDirectory() as path:
+        image_source(path)
+        name = 'benchsvc'
+        image_navigator._images[name] = BandImage(
+            name=f'bench/{name}', path=path, key=name)
+        requests = fake.requests
+        build = await measure(lambda: dock.run_container(name, env={}, build=True), rounds)
+        build['docker_requests'] = (fake.requests - requests) / rounds
+        requests = fake.requests
+        reuse = await measure(lambda: dock.run_container(name, env={}, build=False), rounds)
+        reuse['docker_requests'] = (fake.requests - requests) / rounds
+        del image_navigator._images[name]
+    return dict(build=build, reuse_image=reuse)
+
+
+async def bench_logs(fake, dock, lines):
+    from aiodocker.channel import Channel
+    fake.log_lines = lines
+    container = fake.add_container('logger')
+    docker_container = await dock.dc.containers.get(container.id)
+    channel = Channel()
+    subscriber = channel.subscribe()
+    started = perf_counter()
+    reader = asyncio.ensure_future(
+        dock.logs_reader(dock.dc, docker_container, channel, container.name, container.id))
+    received = 0
+    while received < lines:
+        await subscriber.get()
+        received += 1
+    elapsed = perf_counter() - started
+    reader.cancel()
+    fake.log_lines = None
+    return dict(lines=lines, seconds=elapsed, lines_per_sec=lines / elapsed,
+                bytes_per_sec=lines * fake.log_line_size / elapsed)
+
+
+def compare(current, previous, path=''):
+    """
+    Prints median changes against previous results
+    """
+    for key, value in current.items():
+        prev = previous.get(key) if isinstance(previous, dict) else None
+        if prev is None:
+            continue
+        if isinstance(value, dict) and 'median' in value:
+            ratio = value['median'] / prev['median'] if prev['median'] else 0
+            print(f'{path}{key}: {prev["median"]:.6f}s -> {value["median"]:.6f}s ({ratio:.2f}x)')
+        elif isinstance(value, dict):
+            compare(value, prev, f'{path}{key}.')
+        elif key == 'lines_per_sec':
+            print(f'{path}{key}: {prev:.0f} -> {value:.0f}')
+
+
+async def main(args):
+    fake = FakeDocker(latency=args.latency)
+    # director docker client reads DOCKER_HOST on import
+    os.environ['DOCKER_HOST'] = await fake.start(SOCKET)
+    from director import state
+    from director.state.manager import dock, image_navigator
+
+    results = dict()
+    try:
+        results['resolve_docstatus_all'] = await bench_resolve(fake, state, args.rounds)
+        results['list_snapshot'] = await bench_list(fake, state, args.rounds)
+        results['run_container'] = await bench_run_container(
+            fake, dock, image_navigator, max(1, args.rounds // 5))
+        results['log_ingest'] = await bench_logs(fake, dock, args.log_lines)
+    finally:
+        await dock.close()
+        await fake.stop()
+
+    report = dict(
+        meta=dict(ts=int(time()), python=platform.python_version(),
+                  latency=args.latency, rounds=args.rounds),
+        results=results)
+    print(ujson.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(ujson.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, ujson.loads(f.read())['results'])
+
+
+def cli():
+    parser = argparse.ArgumentParser(description='Director benchmarks')
+    parser.add_argument('--output', help='store results as json')
+    parser.add_argument('--compare', help='previous results json to compare with')
+    parser.add_argument('--latency', type=float, default=0, help='fake docker latency, seconds')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--log-lines', type=int, default=100000)
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    cli()
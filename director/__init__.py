@@ -8,8 +8,13 @@ state = StateManager()
 
 # Required state
 from .queries import *
-from .api import stat_api, manager_api
+from .api import stat_api, manager_api, debug_api
 from . import websocket
+from .watchdog import watchdog
+
+@worker()
+async def __loop_watchdog():
+    await watchdog.run()
 
 @worker()
 async def __state_up():
@@ -20,6 +25,7 @@ async def __state_up():
 async def __state_down():
     logger.debug('Director shutdown worker started')
     await state.unload()
+    watchdog.stop()
 
 __VERSION__ = '0.8.3'
 
@@ -1,8 +1,3 @@
-# import tracemalloc
-
-# tracemalloc.start()
-
-
 from band import settings, start_server
 
 def main():
@@ -1,2 +1,3 @@
 from . import management as manager_api
 from . import stat as stat_api
+from . import debug as debug_api
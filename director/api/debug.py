@@ -0,0 +1,129 @@
+import os
+from aiohttp import web
+from band import expose, settings, dome
+from ..watchdog import watchdog
+from ..profiling import memory_tracer, tasks_summary, profile_loop
+from ..logstorm import LogStorm
+from ..websocket import ws_sender
+from .. import dock
+
+
+def debug_enabled():
+    return bool(settings.get('debug_endpoints'))
+
+
+def capture_path(name):
+    """
+    Capture file inside configured directory, None for anything but plain file name
+    """
+    if not name or name != os.path.basename(name) or name.startswith('.'):
+        return None
+    return os.path.join(settings.get('capture_dir') or '/data/captures', name)
+
+
+@expose(path='/debug/loop')
+async def debug_loop(**params):
+    """
+    Event loop lag and top blocking call sites
+    """
+    if not debug_enabled():
+        return 403
+    return watchdog.report()
+
+
+@expose(path='/debug/tracemalloc/start')
+async def tracemalloc_start(nframes=1, **params):
+    """
+    Start allocations tracing
+    """
+    if not debug_enabled():
+        return 403
+    return memory_tracer.start(int(nframes))
+
+
+@expose(path='/debug/tracemalloc/stop')
+async def tracemalloc_stop(**params):
+    if not debug_enabled():
+        return 403
+    return memory_tracer.stop()
+
+
+@expose(path='/debug/tracemalloc/snapshot')
+async def tracemalloc_snapshot(limit=30, key_type='lineno', **params):
+    """
+    Top allocations, compared to previous snapshot if any
+    """
+    if not debug_enabled():
+        return 403
+    return memory_tracer.diff(int(limit), key_type) or 409
+
+
+@expose(path='/debug/tasks')
+async def debug_tasks(**params):
+    """
+    Live asyncio tasks grouped by coroutine
+    """
+    if not debug_enabled():
+        return 403
+    return tasks_summary()
+
+
+@expose(path='/debug/capture/start')
+async def capture_start(path, **params):
+    """
+    Start recording raw log frames and docker events to capture file.
+    path - file name at capture_dir
+    """
+    if not debug_enabled():
+        return 403
+    full_path = capture_path(path)
+    if not full_path:
+        return 400
+    await dock.start_capture(full_path)
+    return dict(path=full_path)
+
+
+@expose(path='/debug/capture/stop')
+async def capture_stop(**params):
+    if not debug_enabled():
+        return 403
+    return dict(records=await dock.stop_capture())
+
+
+@expose(path='/debug/logstorm')
+async def logstorm(mode='storm', clients=1, **params):
+    """
+    Push load through logs pipeline with simulated websocket clients
+    params:
+    mode - storm or replay
+    clients - number of simulated websocket clients
+    storm: containers, rate (lines/sec per container), seconds, sizes ("80:0.7,400:0.3")
+    replay: path (capture file name at capture_dir), speed
+    """
+    if not debug_enabled():
+        return 403
+    storm = LogStorm(dock, ws_sender, clients=int(clients))
+    if mode == 'replay':
+        full_path = capture_path(params.get('path'))
+        if not full_path:
+            return 400
+        return await storm.replay(full_path, speed=float(params.get('speed', 1)))
+    return await storm.storm(
+        containers=int(params.get('containers', 10)),
+        rate=float(params.get('rate', 100)),
+        seconds=float(params.get('seconds', 10)),
+        sizes=params.get('sizes', '120:1'))
+
+
+async def profile_handler(request):
+    """
+    Sampling profile of event loop in collapsed stack format
+    """
+    if not debug_enabled():
+        return web.Response(status=403)
+    seconds = float(request.query.get('seconds', 5))
+    interval = float(request.query.get('interval', 0.005))
+    return web.Response(text=await profile_loop(seconds, interval))
+
+
+dome.routes.append(web.RouteDef('GET', '/debug/profile', profile_handler, kwargs={}))
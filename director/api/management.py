@@ -1,27 +1,54 @@
 import asyncio
+import ujson
+from time import time
+from aiohttp import web
 from prodict import Prodict as pdict
 from typing import List, Dict
-from band import settings, rpc, logger, expose
+from band import settings, rpc, logger, expose, dome
 from band.constants import (NOTIFY_ALIVE, REQUEST_STATUS, OK, FRONTIER_SERVICE,
                             DIRECTOR_SERVICE)
 from band.lib.response import BaseBandResponse
-from ..constants import (STATUS_RUNNING, STARTED_SET, SHARED_CONFIG_KEY)
+from ..constants import (STATUS_RUNNING, STARTED_SET, SHARED_CONFIG_KEY, PRIORITY_NORMAL,
+                         ROLLING_BATCH, ROLLING_HEALTH_TIMEOUT, CALL_MANY_TIMEOUT,
+                         CALL_MANY_DEADLINE, IMAGES_PRUNE_TIMEOUT)
 from ..structs import RunParams, BuildOptions, ServicePostion
-from ..helpers import merge, req_to_bool
+from ..band_container import replicas_state
+from ..helpers import merge, req_to_bool, BOOT_ID
 from .. import dock, state, image_navigator
+from ..tracing import tracer
+from .. import metrics
+
+RPC_OTHER = 'other'
+# method -> (latency, timeouts) metric children
+RPC_METRICS = {
+    m: (metrics.rpc_request.labels(m), metrics.rpc_timeouts.labels(m))
+    for m in (REQUEST_STATUS, RPC_OTHER)}
+# public fields of images list
+IMAGE_FIELDS = ('name', 'key', 'title', 'path', 'meta')
 """
 Request helpers
 """
 
 
+def job_state(job):
+    """
+    Service state extended with id of job launched by request
+    """
+    return dict(state.state[job.name].full_state(), job=job.id)
+
+
 def build_options_from_req(params: Dict):
     """
     Build BuildOptions from request params
     """
-    return BuildOptions(
+    opts = BuildOptions(
         nocache=req_to_bool(params.get('nocache', None)),
         auto_remove=req_to_bool(params.get('auto_remove', None)),
         env=pdict.from_dict(params.get('env', {})))
+    # kept from saved config when not passed
+    if params.get('replicas'):
+        opts.replicas = max(int(params['replicas']), 1)
+    return opts
 
 
 """
@@ -29,13 +56,23 @@ Band ecosystem methods
 """
 
 
-@expose(path='/list')
-async def states_list():
-    return list(svc.full_state() for svc in state.values()
-                if svc.is_active() or svc.is_local())
+@expose()
+async def states_list(since_version=None, epoch=None, **params):
+    """
+    List of visible services states.
+    With since_version (and epoch of response it came from) returns
+    only services changed after that version
+    """
+    if since_version is not None:
+        try:
+            since_version = int(since_version)
+        except ValueError:
+            return 400
+        return state.list_diff(since_version, epoch)
+    return state.list_snapshot().items
 
 
-@expose(path='/state')
+@expose()
 async def get_state(name=None, prop=None):
     """
     Get list of services in state or get state of specified service
@@ -50,15 +87,54 @@ async def get_state(name=None, prop=None):
     return list(state.state.keys())
 
 
+def cached_response(request, etag, render):
+    """
+    JSON response supporting conditional requests.
+    Body rendered only when client copy is outdated
+    """
+    headers = {'ETag': etag}
+    if request.headers.get('If-None-Match') == etag:
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=render(), content_type='application/json', headers=headers)
+
+
+async def list_handler(request):
+    since_version = request.query.get('since_version')
+    if since_version is not None:
+        try:
+            since_version = int(since_version)
+        except ValueError:
+            return web.Response(status=400)
+        return web.json_response(
+            state.list_diff(since_version, request.query.get('epoch')), dumps=ujson.dumps)
+    snapshot = state.list_snapshot()
+    return cached_response(request, snapshot.etag, lambda: snapshot.body)
+
+
+async def state_handler(request):
+    name = request.query.get('name')
+    prop = request.query.get('prop')
+    if name and name in state and not prop:
+        srv = await state.get(name)
+        full_state = srv.full_state()
+        # versions restart from zero with process, etags must not repeat
+        etag = f'"{BOOT_ID}-{name}-{srv.version}"'
+        return cached_response(request, etag, lambda: ujson.dumps(full_state).encode())
+    return web.json_response(await get_state(name, prop), dumps=ujson.dumps)
+
+
 @expose(path='/show/{name}')
 async def show(name, **params):
     """
     Returns container details
     """
     container = await dock.get(name)
-    if not container:
+    if container:
+        return container.full_state()
+    containers = await dock.service_containers(name, fullinfo=True)
+    if not containers:
         return 404
-    return container and container.full_state()
+    return replicas_state(containers)
 
 
 @expose()
@@ -87,6 +163,20 @@ async def ask_state(name, **params):
     return await rpc.request(name, REQUEST_STATUS)
 
 
+def rpc_metrics(method):
+    """
+    Latency and timeouts children of method. Methods not registered by any
+    service share 'other' label, so callers can't grow labels set
+    """
+    children = RPC_METRICS.get(method)
+    if children is None:
+        if method not in {reg.get('method') for reg in state.registrations()['register']}:
+            return RPC_METRICS[RPC_OTHER]
+        children = RPC_METRICS[method] = (
+            metrics.rpc_request.labels(method), metrics.rpc_timeouts.labels(method))
+    return children
+
+
 @expose(path='/call/{name}/{method}')
 async def call(name, method, **params):
     """
@@ -94,12 +184,95 @@ async def call(name, method, **params):
     Use timeout__ param to set RPC response timeout
     """
     logger.info(f'Calling method "{method}" with params "{params}"')
-    res = await rpc.request(name, method, **params)
+    latency, timeouts = rpc_metrics(method)
+    with latency.time():
+        res = await rpc.request(name, method, **params)
+    if res is None:
+        timeouts.inc()
     if isinstance(res, BaseBandResponse):
         res = res._asdict()
     return res
 
 
+def registered_services(role=None, method=None):
+    """
+    Services having registrations matched by role or method
+    """
+    names = set()
+    for reg in state.registrations()['register']:
+        if role and reg.get('role') != role:
+            continue
+        if not role and method and reg.get('method') != method:
+            continue
+        names.add(reg.get('service'))
+    names.discard(None)
+    return sorted(names)
+
+
+async def timed_call(name, method, timeout, params):
+    started = time()
+    res = dict(service=name)
+    latency, timeouts = rpc_metrics(method)
+    try:
+        with latency.time():
+            # rpc own timeout matched, otherwise it gives up earlier with its default
+            result = await asyncio.wait_for(
+                rpc.request(name, method, timeout__=timeout, **params), timeout)
+        if result is None:
+            timeouts.inc()
+            res['error'] = 'no response'
+        else:
+            res['result'] = result._asdict() if isinstance(result, BaseBandResponse) else result
+    except asyncio.TimeoutError:
+        timeouts.inc()
+        res['error'] = 'timeout'
+    except Exception as exc:
+        res['error'] = repr(exc)
+    res['latency'] = round((time() - started) * 1000, 2)
+    return res
+
+
+@expose(path='/call_many/{method}')
+async def call_many(method, services=None, role=None, timeout=None, deadline=None, **params):
+    """
+    Call method on many services concurrently.
+    services - list or comma separated names. If omitted services are matched
+    against registrations by role or by registered method name.
+    timeout - per call timeout, deadline - for whole request, seconds.
+    Returns results with latency (ms) and errors, unfinished calls marked as deadline
+    """
+    if isinstance(services, str):
+        services = [s for s in services.split(',') if s]
+    try:
+        timeout = float(timeout or CALL_MANY_TIMEOUT)
+        deadline = float(deadline or CALL_MANY_DEADLINE)
+    except (TypeError, ValueError):
+        return 400
+    if not 0 < timeout < float('inf') or not 0 < deadline < float('inf'):
+        return 400
+    names = services or registered_services(role, method)
+    started = time()
+    tasks = {
+        asyncio.ensure_future(timed_call(name, method, timeout, params)): name
+        for name in names}
+    if tasks:
+        await asyncio.wait(tasks, timeout=deadline)
+    results = []
+    for task, name in tasks.items():
+        if task.done():
+            results.append(task.result())
+        else:
+            task.cancel()
+            results.append(dict(service=name, error='deadline',
+                                latency=round((time() - started) * 1000, 2)))
+    return dict(
+        method=method,
+        results=results,
+        ok=sum(1 for r in results if 'error' not in r),
+        failed=sum(1 for r in results if 'error' in r),
+        elapsed=round((time() - started) * 1000, 2))
+
+
 """
 Images methods
 """
@@ -110,7 +283,14 @@ async def list_images(**params):
     """
     Available images list
     """
-    return await image_navigator.lst()
+    images = []
+    for img in await image_navigator.lst():
+        # loaded images also hold docker inspect data
+        item = {k: img.get(k) for k in IMAGE_FIELDS}
+        if state.prebuilder.enabled:
+            item['prebuild'] = state.prebuilder.status(img.key or img.name)
+        images.append(item)
+    return images
 
 
 """
@@ -126,6 +306,7 @@ async def run(name, **req_params):
     pos - string contains prefered coordinates, for example "2x3" (col x row)
     nocache - Set docker build option. By default nocache=false. 
     auto_remove - Set docker build option.
+    replicas - number of service containers (name-1..N). Saved with config
     env - 
     """
 
@@ -140,8 +321,59 @@ async def run(name, **req_params):
     svc = await state.get(name, params=params)
     logger.info('request with params', params=params, srv_config=svc.config)
 
-    svc = await state.run_service(name, no_wait=True)
-    return svc.full_state()
+    job = await state.run_service(
+        name, no_wait=True, priority=int(req_params.get('priority', PRIORITY_NORMAL)))
+    return job_state(job)
+
+
+@expose()
+async def reconcile_plan(**params):
+    """
+    Dry run of autostart reconciliation: actions required to remove drift
+    """
+    return [a._asdict() for a in await state.reconciler.plan()]
+
+
+@expose()
+async def reconcile(**params):
+    """
+    Apply autostart reconciliation plan
+    """
+    return [a._asdict() for a in await state.reconciler.reconcile()]
+
+
+@expose()
+async def rolling_apply(batch=None, timeout=None, **params):
+    """
+    Recreate services which env changed (for example after __shared__ update)
+    in batches, waiting each batch become healthy.
+    Runs as job, report is job result. Active job returned if already running
+    """
+    defaults = settings.get('rolling_apply') or {}
+    try:
+        batch = int(batch or defaults.get('batch', ROLLING_BATCH))
+        timeout = float(timeout or defaults.get('health_timeout', ROLLING_HEALTH_TIMEOUT))
+    except ValueError:
+        return 400
+    job = await state.rolling_apply(batch=batch, health_timeout=timeout)
+    return job.as_dict()
+
+
+@expose()
+async def prune_images(timeout=None, **params):
+    """
+    Remove old images versions and dangling images.
+    Each removal waits for heavy operation slot after deploys,
+    503 if prune not finished in timeout, removed images stay removed
+    """
+    try:
+        timeout = float(timeout or IMAGES_PRUNE_TIMEOUT)
+    except ValueError:
+        return 400
+    try:
+        return await asyncio.wait_for(state.prune_images(), timeout)
+    except asyncio.TimeoutError:
+        return 503
 
 
 @expose(path='/set_pos/{name}')
@@ -175,8 +407,8 @@ async def restart(name, **params):
     """
     Restart service
     """
-    svc = await state.restart_service(name, no_wait=True)
-    return svc.full_state()
+    job = await state.restart_service(name, no_wait=True)
+    return job_state(job)
 
 
 @expose(path='/stop/{name}')
@@ -188,8 +420,8 @@ async def stop(name, **params):
     if not state.is_exists(name):
         return 404
     # executing main action
-    svc = await state.stop_service(name, no_wait=True)
-    return svc.full_state()
+    job = await state.stop_service(name, no_wait=True)
+    return job_state(job)
 
 
 @expose(path='/start/{name}')
@@ -200,8 +432,8 @@ async def start(name, **params):
     if not state.is_exists(name):
         return 404
     # executing main action
-    svc = await state.start_service(name, no_wait=True)
-    return svc.full_state()
+    job = await state.start_service(name, no_wait=True)
+    return job_state(job)
 
 
 @expose(path='/rm/{name}')
@@ -212,8 +444,64 @@ async def remove(name, **params):
     # check container exists
     if not state.is_exists(name):
         return 404
-    svc = await state.remove_service(name, no_wait=True)
-    return svc.full_state()
+    job = await state.remove_service(name, no_wait=True)
+    return job_state(job)
+
+
+"""
+Jobs
+"""
+
+
+@expose()
+async def health_probes(**params):
+    """
+    Status probes scheduler state and per-service availability
+    """
+    return state.health.report()
+
+
+@expose()
+async def latency(name=None, **params):
+    """
+    Lifecycle phases latency per service: count, p50, p95, max
+    """
+    return tracer.report(name)
+
+
+@expose()
+async def jobs(name=None, active=None, **params):
+    """
+    Lifecycle jobs with phases and timings, queue stats
+    params:
+    name - filter by service
+    active - only unfinished (true) or finished (false) jobs
+    """
+    return dict(
+        stats=state.ops.stats(),
+        jobs=[j.as_dict() for j in state.ops.jobs.list(name=name, active=req_to_bool(active))])
+
+
+@expose(path='/jobs/{job_id}')
+async def job_info(job_id, **params):
+    """
+    Job details
+    """
+    job = state.ops.jobs.get(job_id)
+    if not job:
+        return 404
+    return job.as_dict()
+
+
+@expose(path='/cancel_job/{job_id}')
+async def cancel_job(job_id, **params):
+    """
+    Cancel queued job or build in progress
+    """
+    job = state.ops.jobs.get(job_id)
+    if not job:
+        return 404
+    return dict(cancelled=state.ops.cancel(job.id), job=job.as_dict())
 
 
 """
@@ -245,3 +533,15 @@ async def get_config(name, **params):
     Returns service config
     """
     return await state.load_config(name)
+
+
+async def metrics_handler(request):
+    return web.Response(
+        body=metrics.render().encode(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+# Registering routes with conditional requests support
+dome.routes.append(web.RouteDef('GET', '/list', list_handler, kwargs={}))
+dome.routes.append(web.RouteDef('GET', '/state', state_handler, kwargs={}))
+dome.routes.append(web.RouteDef('GET', '/metrics', metrics_handler, kwargs={}))
@@ -5,6 +5,10 @@ from band import expose, logger, settings
 from simplech import AsyncClickHouse
 from async_timeout import timeout
 from .. import stat_queries
+from .. import metrics
+
+CH_COMMON = metrics.clickhouse_query.labels('common_stat')
+CH_EVENTS = metrics.clickhouse_query.labels('events_stat')
 
 ch = AsyncClickHouse()
 
@@ -14,7 +18,8 @@ async def common_stat(**params):
     query = stat_queries.groups(where) + stat_queries.FMT_JSON
     try:
         async with timeout(1):
-            stat_groups = await ch.select(query)
+            with CH_COMMON.time():
+                stat_groups = await ch.select(query)
             if stat_groups:
                 return ujson.loads(stat_groups)['data']
     except asyncio.TimeoutError:
@@ -30,7 +35,8 @@ async def events_stat(**params):
     query = stat_queries.events(events_where) + stat_queries.FMT_JSON
     try:
         async with timeout(1):
-            stat_events = await ch.select(query)
+            with CH_EVENTS.time():
+                stat_events = await ch.select(query)
             return ujson.loads(stat_events)['data'] if stat_events else []
     except asyncio.TimeoutError:
         logger.exception('stat get error')
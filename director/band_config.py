@@ -1,13 +1,30 @@
+import asyncio
 import ujson
+from copy import deepcopy
 import yaml
 import time
 import os
 import aioredis
 from prodict import Prodict
-from band import app, settings, redis_factory, logger
+from band import app, settings, redis_factory, logger, scheduler
+from . import metrics
 
 SERVICE_PREFIX = 'band-config-'
 SET_PREFIX = 'band-set-'
+SNAPSHOT_PREFIX = 'band-snapshot-'
+# set of stored config names, does not match SERVICE_PREFIX pattern
+CONFIG_INDEX = 'band-configs-index'
+SCAN_COUNT = 500
+# keyspace notifications about all band keys in any db
+KEYSPACE_PATTERN = '__keyspace@*__:band-*'
+KEYSPACE_EVENTS = 'K$sg'
+RESUBSCRIBE_DELAY = 1
+WRITE_BEHIND = 0.05
+# retry delay of failed flush doubles up to this, seconds
+FLUSH_MAX_BACKOFF = 10
+
+# attempts of optimistic config update, concurrent writes are rare
+UPDATE_RETRIES = 5
 
 
 def pconf(name):
@@ -23,19 +40,212 @@ def pset(name):
     return f'{SET_PREFIX}{name}'
 
 
+def psnapshot(name):
+    return f'{SNAPSHOT_PREFIX}{name}'
+
+
 def decode(name):
     return name.decode()
 
 
+def apply_updates(doc, keysvals):
+    """
+    Applies dot-path updates to config document in place, empty value removes path
+    """
+    for path, value in keysvals.items():
+        *parents, last = path.split('.')
+        target = doc
+        for part in parents:
+            if not isinstance(target.get(part), dict):
+                target[part] = {}
+            target = target[part]
+        if value == '':
+            target.pop(last, None)
+        else:
+            target[last] = value
+    return doc
+
+
+def as_config(data):
+    # cached documents never leave the cache
+    return Prodict.from_dict(deepcopy(data)) if isinstance(data, dict) else data
+
+
 class BandConfig:
     def __init__(self, *args, **kwargs):
         self.redis_pool = None
+        self.cache_params = settings.get('config_cache') or {}
+        # decoded config documents and sets, valid while subscribed
+        self._configs = dict()
+        self._sets = dict()
+        self._cached = False
+        self._generation = 0
+        self._listener = None
+        # write-behind buffers: config name -> raw, set name -> {member: present}
+        self._pending = dict()
+        self._pending_sets = dict()
+        self._flusher = None
+        self._flush_lock = asyncio.Lock()
+        self._flush_failures = 0
+        self.write_behind = self.cache_params.get('write_behind', WRITE_BEHIND)
 
     async def initialize(self):
         logger.info("Initializing BandConfig")
         self.redis_pool = await redis_factory.create_pool()
+        if self.cache_params.get('enabled') and await self.setup_notifications():
+            self._listener = await scheduler.spawn(self.__listen())
         logger.debug('Band state configs holder started')
 
+    """
+    Local cache
+    """
+
+    async def setup_notifications(self):
+        """
+        Checks keyspace notifications required for cache coherence.
+        Returns False if cache can't be used
+        """
+        try:
+            _, flags = await self.__redis_cmd('config', 'get', 'notify-keyspace-events')
+            flags = decode(flags)
+            enabled = 'A' in flags or set('$sg') <= set(flags)
+            if 'K' in flags and enabled:
+                return True
+            if not self.cache_params.get('setup_notifications'):
+                logger.warn('keyspace notifications disabled, config cache turned off',
+                            flags=flags)
+                return False
+            # affects whole redis instance
+            flags = ''.join(sorted(set(flags) | set(KEYSPACE_EVENTS)))
+            await self.__redis_cmd('config', 'set', 'notify-keyspace-events', flags)
+        except aioredis.ReplyError as exc:
+            # CONFIG is often renamed or forbidden on managed redis
+            logger.warn('keyspace notifications unavailable, config cache turned off',
+                        error=str(exc))
+            return False
+        logger.info('keyspace notifications enabled', flags=flags)
+        return True
+
+    async def __listen(self):
+        while True:
+            channel = aioredis.Channel(KEYSPACE_PATTERN, is_pattern=True)
+            try:
+                await self.redis_pool.execute_pubsub('psubscribe', channel)
+                # cache is filled only after subscription established
+                self._cached = True
+                logger.debug('config cache subscribed')
+                while await channel.wait_message():
+                    key, _ = await channel.get()
+                    self.invalidate(decode(key).split(':', 1)[1])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('config cache subscription')
+            finally:
+                self.drop_cache()
+            await asyncio.sleep(RESUBSCRIBE_DELAY)
+
+    def invalidate(self, key):
+        self._generation += 1
+        if key.startswith(SERVICE_PREFIX):
+            self._configs.pop(key[len(SERVICE_PREFIX):], None)
+        elif key.startswith(SET_PREFIX):
+            self._sets.pop(key[len(SET_PREFIX):], None)
+
+    def drop_cache(self):
+        self._cached = False
+        self._generation += 1
+        self._configs.clear()
+        self._sets.clear()
+
+    def __remember(self, storage, key, value, generation):
+        # skip values loaded while invalidation happened
+        if self._cached and generation == self._generation:
+            storage[key] = value
+
+    """
+    Write-behind buffer
+    """
+
+    def __schedule_flush(self):
+        if not self._flusher:
+            delay = min(self.write_behind * 2 ** self._flush_failures, FLUSH_MAX_BACKOFF)
+            self._flusher = asyncio.ensure_future(self.__delayed_flush(delay))
+
+    async def __delayed_flush(self, delay):
+        await asyncio.sleep(delay)
+        self._flusher = None
+        try:
+            await self.flush()
+        except Exception:
+            # already logged and rescheduled
+            pass
+
+    def __stage_set(self, key, present, members):
+        ops = self._pending_sets.setdefault(key, dict())
+        for member in members:
+            ops[member] = present
+        if key in self._sets:
+            if present:
+                self._sets[key].update(members)
+            else:
+                self._sets[key].difference_update(members)
+        self.__schedule_flush()
+
+    def __apply_pending(self, key, members):
+        for member, present in self._pending_sets.get(key, {}).items():
+            if present:
+                members.add(member)
+            else:
+                members.discard(member)
+        return members
+
+    async def flush(self):
+        """
+        Writes buffered configs and sets changes in single transaction
+        """
+        # flushes are serialized to keep writes order
+        async with self._flush_lock:
+            await self.__flush()
+
+    async def __flush(self):
+        if not self._pending and not self._pending_sets:
+            return
+        configs, self._pending = self._pending, dict()
+        sets, self._pending_sets = self._pending_sets, dict()
+        batch = len(configs) + sum(map(len, sets.values()))
+        try:
+            with metrics.config_flush.time(), await self.redis_pool as conn:
+                futures = [conn.execute('multi')]
+                for name, raw in configs.items():
+                    futures.append(conn.execute('set', pconf(name), raw))
+                if configs:
+                    futures.append(conn.execute('sadd', CONFIG_INDEX, *configs))
+                for key, ops in sets.items():
+                    added = [m for m, present in ops.items() if present]
+                    removed = [m for m, present in ops.items() if not present]
+                    if added:
+                        futures.append(conn.execute('sadd', pset(key), *added))
+                    if removed:
+                        futures.append(conn.execute('srem', pset(key), *removed))
+                futures.append(conn.execute('exec'))
+                await asyncio.gather(*futures)
+        except Exception:
+            self._flush_failures += 1
+            logger.exception('config flush failed', batch=batch, failures=self._flush_failures)
+            # return to buffer everything not overwritten meanwhile
+            for name, raw in configs.items():
+                self._pending.setdefault(name, raw)
+            for key, ops in sets.items():
+                pending = self._pending_sets.setdefault(key, dict())
+                for member, present in ops.items():
+                    pending.setdefault(member, present)
+            self.__schedule_flush()
+            raise
+        self._flush_failures = 0
+        metrics.config_flush_batch.observe(batch)
+        logger.debug('config flushed', batch=batch)
+
     def encode(self, **data):
         return ujson.dumps(data, ensure_ascii=False).encode()
 
@@ -44,37 +254,150 @@ class BandConfig:
             return ujson.loads(raw.decode())
 
     async def __redis_cmd(self, cmd, *args):
-        with await self.redis_pool as conn:
-            return await conn.execute(cmd, *args)
+        with metrics.redis_cmd.labels(cmd).time():
+            with await self.redis_pool as conn:
+                return await conn.execute(cmd, *args)
 
     async def set_exists(self, key):
+        if key in self._sets:
+            return bool(self._sets[key])
+        if any(self._pending_sets.get(key, {}).values()):
+            return True
         return await self.__redis_cmd('exists', pset(key))
 
     async def set_add(self, key, *args):
-        await self.__redis_cmd('sadd', pset(key), *args)
+        self.__stage_set(key, True, args)
 
     async def set_rm(self, key, *args):
-        await self.__redis_cmd('srem', pset(key), *args)
+        self.__stage_set(key, False, args)
 
     async def set_get(self, key):
-        return set(map(decode, await self.__redis_cmd('smembers', pset(key))))
+        if key in self._sets:
+            metrics.config_cache.labels('hit').inc()
+            return set(self._sets[key])
+        metrics.config_cache.labels('miss').inc()
+        generation = self._generation
+        members = set(map(decode, await self.__redis_cmd('smembers', pset(key))))
+        # cached sets include buffered changes, same as ones staged after
+        members = self.__apply_pending(key, members)
+        self.__remember(self._sets, key, members, generation)
+        return set(members)
 
     async def configs_list(self):
-        return list(
-            map(upconf,
-                map(decode, await self.__redis_cmd('keys',
-                                                   f'{SERVICE_PREFIX}*'))))
+        return list(map(decode, await self.__redis_cmd('smembers', CONFIG_INDEX)))
+
+    async def migrate_index(self):
+        """
+        Fill config names index from existing keys using incremental SCAN
+        """
+        if await self.__redis_cmd('exists', CONFIG_INDEX):
+            return
+        cursor = b'0'
+        names = []
+        while True:
+            cursor, keys = await self.__redis_cmd(
+                'scan', cursor, 'match', f'{SERVICE_PREFIX}*', 'count', SCAN_COUNT)
+            names.extend(upconf(decode(k)) for k in keys)
+            if cursor in (b'0', 0, '0'):
+                break
+        if names:
+            await self.__redis_cmd('sadd', CONFIG_INDEX, *names)
+        logger.info('configs index created', count=len(names))
 
-    async def save_config(self, name, params):
+    def save_config(self, name, params):
+        """
+        Buffers config write, latest write per name wins
+        """
         raw = self.encode(**params)
-        with await self.redis_pool as conn:
-            await conn.execute('set', pconf(name), raw)
+        self._pending[name] = raw
+        self.__remember(self._configs, name, self.decode(raw), self._generation)
+        self.__schedule_flush()
 
     async def load_config(self, name):
-        with await self.redis_pool as conn:
-            raw = await conn.execute('get', pconf(name))
+        if name in self._pending:
+            return as_config(self.decode(self._pending[name]))
+        if name in self._configs:
+            metrics.config_cache.labels('hit').inc()
+            return as_config(self._configs[name])
+        metrics.config_cache.labels('miss').inc()
+        generation = self._generation
+        data = self.decode(await self.__redis_cmd('get', pconf(name)))
+        self.__remember(self._configs, name, data, generation)
+        return as_config(data)
+
+    async def update_config(self, name, keysvals):
+        """
+        Applies dot-path updates under WATCH, retried if config changed concurrently.
+        Returns updated config.
+        Document is merged here and rewritten whole, two round trips per attempt:
+        server-side update by Lua cjson is lossy (empty lists become objects,
+        numbers lose precision, sparse arrays fail)
+        """
+        if name in self._pending:
+            # update should see buffered version
+            await self.flush()
+        key = pconf(name)
+        for _ in range(UPDATE_RETRIES):
+            with metrics.redis_cmd.labels('update').time(), await self.redis_pool as conn:
+                _, raw = await asyncio.gather(conn.execute('watch', key), conn.execute('get', key))
+                try:
+                    data = apply_updates(self.decode(raw) or {}, keysvals)
+                except Exception:
+                    await conn.execute('unwatch')
+                    raise
+                futures = [
+                    conn.execute('multi'),
+                    conn.execute('set', key, self.encode(**data)),
+                    conn.execute('sadd', CONFIG_INDEX, name),
+                    conn.execute('exec')]
+                results = (await asyncio.gather(*futures))[-1]
+            if not any(isinstance(r, aioredis.WatchVariableError) for r in results):
+                self.__remember(self._configs, name, data, self._generation)
+                return as_config(data)
+            logger.debug('config changed concurrently, retrying update', name=name)
+        raise aioredis.WatchVariableError(f'config {name} update conflict')
+
+    async def save_snapshot(self, name, data):
+        await self.__redis_cmd('set', psnapshot(name), self.encode(**data))
+
+    async def load_snapshot(self, name):
+        return self.decode(await self.__redis_cmd('get', psnapshot(name)))
+
+    async def load_configs(self, names):
+        """
+        Load configs by single MGET. Returns dict name -> config
+        """
+        result = dict()
+        missing = []
+        for name in names:
+            if name in self._pending:
+                result[name] = as_config(self.decode(self._pending[name]))
+            elif name in self._configs:
+                result[name] = as_config(self._configs[name])
+            else:
+                missing.append(name)
+        metrics.config_cache.labels('hit').inc(len(result))
+        if not missing:
+            return result
+        metrics.config_cache.labels('miss').inc(len(missing))
+        generation = self._generation
+        raws = await self.__redis_cmd('mget', *map(pconf, missing))
+        for name, raw in zip(missing, raws):
             data = self.decode(raw)
-        return Prodict.from_dict(data) if isinstance(data, dict) else data
+            self.__remember(self._configs, name, data, generation)
+            result[name] = as_config(data)
+        return result
 
     async def unload(self):
+        if self._listener:
+            await self._listener.close()
+        if self._flusher:
+            self._flusher.cancel()
+            self._flusher = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.error('buffered config writes lost',
+                         configs=list(self._pending), sets=list(self._pending_sets))
+        self.drop_cache()
         await redis_factory.close_pool(self.redis_pool)
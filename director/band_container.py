@@ -1,19 +1,36 @@
 import arrow
 from prodict import Prodict
 from pprint import pprint
-from typing import List
+from time import time
 
 from band import logger
 
-from .constants import STATUS_RUNNING
+from .constants import STATUS_RUNNING, CONFIG_HASH_LABEL, SERVICE_LABEL, REPLICA_LABEL
 
 
-class BCP(Prodict):
-    PublicPort: int
+def replica_names(name, replicas):
+    """
+    Containers names of service. Single container named after service
+    """
+    if not replicas or replicas <= 1:
+        return [name]
+    return [f'{name}-{i}' for i in range(1, replicas + 1)]
 
 
-class BC(Prodict):
-    Ports: List[BCP]
+def replicas_state(containers):
+    """
+    Docker state of service aggregated over its containers
+    """
+    if len(containers) == 1 and containers[0].replica is None:
+        return containers[0].full_state()
+    states = [c.full_state() for c in containers]
+    running = [s for s in states if s.running]
+    state = (running or states)[0]
+    state.replicas = [
+        dict(name=c.name, running=s.running, state=s.state, uptime=s.uptime)
+        for c, s in zip(containers, states)]
+    state.replicas_running = len(running)
+    return state
 
 
 class BandContainerBuilder():
@@ -21,14 +38,18 @@ class BandContainerBuilder():
         self.image = image
 
     def run_struct(self, name, network, memory, bind_ip, host_ports,
-                   auto_remove, etc_hosts, env, **kwargs):
+                   auto_remove, etc_hosts, env, config_hash=None, replica=None, **kwargs):
+        labels = {'inband': 'native', SERVICE_LABEL: name}
+        if config_hash:
+            labels[CONFIG_HASH_LABEL] = config_hash
+        if replica:
+            labels[REPLICA_LABEL] = str(replica)
         return Prodict.from_dict({
             'Image': self.image.id,
+            # replicas share service hostname
             'Hostname': name,
             'Cmd': self.image.cmd,
-            'Labels': {
-                'inband': 'native'
-            },
+            'Labels': labels,
             'Env': [f"{k}={v}" for k, v in env.items()],
             'StopSignal': 'SIGTERM',
             'HostConfig': {
@@ -49,33 +70,38 @@ class BandContainerBuilder():
 
 
 class BandContainer():
+    """
+    Lazy view over raw docker container document (list or inspect form)
+    """
+    __slots__ = ('c', '_parsed')
+
     def __init__(self, container):
         self.c = container
-        self.d: BC = BC()
-        self.copy()
+        # parsed values cache, valid until container data refreshed
+        self._parsed = {}
 
-    def copy(self):
-        self.d: BC = BC.from_dict(self.c._container)
+    @property
+    def raw(self):
+        return self.c._container
 
     def print(self):
-        pprint(self.d)
+        pprint(self.raw)
 
     async def fill(self):
         await self.c.show()
-        self.copy()
+        self._parsed = {}
         return self
 
     async def ensure_filled(self):
-        if not self.d.State:
-            await self.c.show()
-        self.copy()
+        if not self.raw.get('State'):
+            await self.fill()
 
     def auto_removable(self):
-        return self.d.HostConfig.AutoRemove
+        return (self.raw.get('HostConfig') or {}).get('AutoRemove')
 
     @property
     def id(self):
-        return self.d.Id
+        return self.raw.get('Id')
 
     @property
     def container(self):
@@ -83,19 +109,21 @@ class BandContainer():
 
     @property
     def name(self):
-        if self.d.Names:
-            return self.d.Names[0].strip('/')
-        return self.d.Name.strip('/')
+        names = self.raw.get('Names')
+        if names:
+            return names[0].strip('/')
+        return (self.raw.get('Name') or '').strip('/')
 
     @property
     def short_id(self):
-        return self.d.Id[:12]
+        return (self.id or '')[:12]
 
     @property
     def status(self):
-        if isinstance(self.d.State, dict):
-            return self.d.State.Status
-        return self.d.State
+        state = self.raw.get('State')
+        if isinstance(state, dict):
+            return state.get('Status')
+        return state
 
     @property
     def state(self):
@@ -108,48 +136,95 @@ class BandContainer():
 
     @property
     def ports(self):
-        if self.d.Ports:
-            return [p for p in [pcf.get('PublicPort') for pcf in self.d.get('Ports')] if p]
-        if self.d.HostConfig.PortBindings:
-            return list(self.d.HostConfig.PortBindings.keys())
+        """
+        Host ports used by container
+        """
+        if self.raw.get('Ports'):
+            return [p for p in [pcf.get('PublicPort') for pcf in self.raw['Ports']] if p]
+        bindings = (self.raw.get('HostConfig') or {}).get('PortBindings')
+        if bindings:
+            return [int(b['HostPort']) for binds in bindings.values() for b in (binds or [])
+                    if b.get('HostPort')]
         return []
 
     @property
     def started_at(self):
-        if isinstance(self.d.State, dict):
-            if self.d.State.Running == True:
-                return arrow.get(self.d.State.StartedAt)
+        """
+        Container start unix time in seconds
+        """
+        if 'started_at' not in self._parsed:
+            started_at = None
+            state = self.raw.get('State')
+            if isinstance(state, dict) and state.get('Running') == True:
+                started_at = arrow.get(state['StartedAt']).timestamp
+            self._parsed['started_at'] = started_at
+        return self._parsed['started_at']
 
     @property
     def create_ts(self):
-        if self.d.Created:
-            created = self.d.Created
+        if 'create_ts' not in self._parsed:
+            created = self.raw.get('Created')
+            create_ts = None
             if isinstance(created, int):
-                return created
-            elif isinstance(created, str):
-                return arrow.get(created).timestamp * 1000
+                create_ts = created
+            elif isinstance(created, str) and created:
+                create_ts = arrow.get(created).timestamp * 1000
+            self._parsed['create_ts'] = create_ts
+        return self._parsed['create_ts']
 
     @property
     def data(self):
-        return self.d
+        return self.raw
 
     def labels(self):
-        if self.d.Labels:
-            return self.d.Labels
-        elif self.d.Config and self.d.Config.Labels:
-            return self.d.Config.Labels
-        return Prodict()
+        if self.raw.get('Labels'):
+            return self.raw['Labels']
+        config = self.raw.get('Config')
+        if config and config.get('Labels'):
+            return config['Labels']
+        return {}
 
     def inband(self):
-        return bool(self.labels().inband)
+        return bool(self.labels().get('inband'))
 
     @property
     def inband_val(self):
-        return self.labels().inband
+        return self.labels().get('inband')
 
     @property
     def native(self):
-        return self.labels().inband == 'native'
+        return self.labels().get('inband') == 'native'
+
+    @property
+    def config_hash(self):
+        return self.labels().get(CONFIG_HASH_LABEL)
+
+    @property
+    def env(self):
+        """
+        Container environment including image defaults. Requires inspect data
+        """
+        pairs = ((self.raw.get('Config') or {}).get('Env') or [])
+        return dict(p.split('=', 1) for p in pairs if '=' in p)
+
+    @property
+    def service(self):
+        """
+        Name of service container belongs to
+        """
+        return self.labels().get(SERVICE_LABEL) or self.name
+
+    @property
+    def replica(self):
+        replica = self.labels().get(REPLICA_LABEL)
+        return int(replica) if replica else None
+
+    @property
+    def image_id(self):
+        """
+        Id of image container created from
+        """
+        return self.raw.get('ImageID') or self.raw.get('Image')
 
     @property
     def short_info(self):
@@ -157,14 +232,11 @@ class BandContainer():
             name=self.name, short_id=self.short_id, state=self.status, status=self.status)
 
     def full_state(self):
-        started_at = self.started_at or 0
-        start_ts = 0
+        start_ts = self.started_at or 0
         uptime_sec = 0
-        if started_at:
-            start_ts = started_at.timestamp
-            now_ts = arrow.now().timestamp
-            uptime_sec = now_ts - start_ts
-            uptime_sec = uptime_sec if uptime_sec > 0 else 0
+        if start_ts:
+            uptime_sec = time() - start_ts
+            uptime_sec = int(uptime_sec) if uptime_sec > 0 else 0
 
         return Prodict(
             running=self.running,
@@ -2,7 +2,7 @@ import subprocess
 from prodict import Prodict as pdict
 from typing import Dict
 
-from .constants import (DEF_LABELS, DEFAULT_DOCKERFILE, GIT_IGNORE_POSTFIX)
+from .constants import (DEF_LABELS, DEFAULT_DOCKERFILE, GIT_IGNORE_POSTFIX, IMAGE_LABEL)
 from .helpers import tar_image_cmd
 
 class BandImageBuilder:
@@ -34,6 +34,8 @@ class BandImageBuilder:
             'fileobj': self.p.stdout,
             'encoding': 'identity',
             'buildargs': self.img_options.get('buildargs', {}),
+            # marks images subject of retention policy
+            'labels': {IMAGE_LABEL: self.img.name},
             'path_dockerfile': self.dockerfile,
             'nocache': self.img_options.get('nocache', False),
             'forcerm': self.img_options.get('forcerm', True),
@@ -17,3 +17,69 @@ SHARED_CONFIG_KEY = '__shared__'
 
 DEFAULT_DOCKERFILE = 'Dockerfile'
 GIT_IGNORE_POSTFIX = '.gignore'
+
+CONFIG_HASH_LABEL = 'band.director.config-hash'
+SERVICE_LABEL = 'band.director.service'
+REPLICA_LABEL = 'band.director.replica'
+IMAGE_LABEL = 'band.director.image'
+IMAGES_KEEP = 3
+IMAGES_GC_INTERVAL = 3600
+# max duration of prune requested by api, seconds
+IMAGES_PRUNE_TIMEOUT = 600
+META_LABEL_PREFIX = 'band.service.'
+META_DESCRIPTOR = 'band.yml'
+
+ACTION_NONE = 'none'
+ACTION_START = 'start'
+ACTION_RECREATE = 'recreate'
+ACTION_REBUILD = 'rebuild'
+RECONCILE_CONCURRENCY = 3
+ROLLING_BATCH = 2
+ROLLING_HEALTH_TIMEOUT = 60
+HEALTH_POLL_INTERVAL = 1
+
+SNAPSHOT_KEY = 'director-state'
+SNAPSHOT_FILE = 'director_state.json'
+SNAPSHOT_INTERVAL = 10
+LIST_CACHE_TTL = 5
+
+STATE_BUS_HISTORY = 1000
+STATE_BUS_QUEUE = 1000
+
+OP_RUN = 'run'
+OP_START = 'start'
+OP_STOP = 'stop'
+OP_RESTART = 'restart'
+OP_REMOVE = 'remove'
+OP_PREBUILD = 'prebuild'
+OP_ROLLING_APPLY = 'rolling_apply'
+# queue of operations not bound to single service
+ROLLING_APPLY_KEY = '__rolling_apply__'
+HEAVY_OPS = (OP_RUN, OP_PREBUILD)
+HEAVY_OPS_LIMIT = 2
+
+JOB_QUEUED = 'queued'
+JOB_WAITING = 'waiting'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+JOB_MERGED = 'merged'
+JOB_FINISHED = (JOB_DONE, JOB_FAILED, JOB_CANCELLED, JOB_MERGED)
+JOBS_HISTORY = 200
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 10
+
+LATENCY_SAMPLES = 500
+# spans started by begin() and never finished are dropped after, seconds
+PENDING_SPAN_TTL = 600
+PROBE_TICK = 0.5
+PROBE_WHEEL_SLOTS = 512
+PROBE_MIN_INTERVAL = 2
+PROBE_MAX_INTERVAL = 60
+PROBE_STABLE_STREAK = 3
+PROBE_MAX_INFLIGHT = 20
+PROBE_SYNC_INTERVAL = 5
+CALL_MANY_TIMEOUT = 5
+CALL_MANY_DEADLINE = 15
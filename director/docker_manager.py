@@ -24,20 +24,38 @@ from aiodocker.logs import DockerLog
 from aiodocker.channel import Channel, ChannelSubscriber
 from aiodocker.containers import DockerContainer
 from prodict import Prodict as pdict
-from time import time
+from time import time, perf_counter
+from contextlib import asynccontextmanager
 from typing import Set, List, Dict
 from pprint import pprint
 
 from band import logger, scheduler, loop
 from .image_navigator import ImageNavigator
-from .band_container import BandContainer, BandContainerBuilder
-from .constants import DEF_LABELS, STATUS_RUNNING
-from .helpers import req_to_bool, def_val
+from .band_container import BandContainer, BandContainerBuilder, replica_names
+from .constants import DEF_LABELS, STATUS_RUNNING, IMAGE_LABEL, IMAGES_KEEP
+from .helpers import req_to_bool, def_val, config_hash
 from .flake import Flake
 from .structs import LogRecord
+from .tracing import tracer
+from .log_capture import LogCapture
+from . import metrics
 from base64 import b64encode
 
 idgen = Flake()
+
+DOCKER_LIST = metrics.docker_api.labels('containers_list')
+DOCKER_INSPECT = metrics.docker_api.labels('container_inspect')
+DOCKER_GET = metrics.docker_api.labels('container_get')
+DOCKER_STOP = metrics.docker_api.labels('container_stop')
+DOCKER_START = metrics.docker_api.labels('container_start')
+DOCKER_RESTART = metrics.docker_api.labels('container_restart')
+DOCKER_DELETE = metrics.docker_api.labels('container_delete')
+DOCKER_RUN = metrics.docker_api.labels('container_run')
+DOCKER_BUILD = metrics.docker_api.labels('image_build')
+DOCKER_IMAGE_INSPECT = metrics.docker_api.labels('image_inspect')
+DOCKER_IMAGE_LIST = metrics.docker_api.labels('images_list')
+DOCKER_IMAGE_DELETE = metrics.docker_api.labels('image_delete')
+DOCKER_PRUNE = metrics.docker_api.labels('prune')
 logs_sources = {
     '1': 'stdin',
     '2': 'stderr'
@@ -91,6 +109,12 @@ logs_sources = {
 [00]  'timeNano': 1563759746606291500}
 """
 
+
+@asynccontextmanager
+async def no_slot():
+    yield
+
+
 class DockerManager():
     image_navigator: ImageNavigator
     reserved_ports: Set
@@ -117,6 +141,26 @@ class DockerManager():
         # common container params
         self.container_params = pdict.from_dict(container_params)
         self.image_params = pdict.from_dict(image_params)
+        self.logs = None
+        # raw logs and events capture for later replay
+        self.capture = None
+        metrics.CallbackGauge(
+            'director_channel_queue_depth', 'Pending messages of logs channel subscribers',
+            self.queues_depth, labels=('subscriber',))
+
+    def queues_depth(self):
+        queues = getattr(self.logs, 'queues', None) or []
+        return {(str(i),): q.qsize() for i, q in enumerate(queues)}
+
+    async def start_capture(self, path):
+        await self.stop_capture()
+        self.capture = await LogCapture(path).open()
+
+    async def stop_capture(self):
+        capture, self.capture = self.capture, None
+        if capture:
+            await capture.close()
+            return capture.records
 
     async def initialize(self):
         self.logs = Channel()
@@ -138,10 +182,16 @@ class DockerManager():
             # ),
 
 
-    async def logs_reader(self, docker, container: DockerContainer, channel: Channel, name, cid):
+    async def logs_reader(self, docker, container: DockerContainer, channel: Channel, name, cid,
+                          metered=True):
+        """
+        metered - count lines in metrics and write to capture
+        """
         log_reader = container.logs
         subscriber = log_reader.subscribe()
         unixts = int(time())
+        lines = metrics.log_lines.labels(name)
+        nbytes = metrics.log_bytes.labels(name)
         
         await scheduler.spawn(log_reader.run(since=unixts))
         while True:
@@ -150,6 +200,8 @@ class DockerManager():
             if log_record is None:
                 logger.info('closing docker logs reader')
                 break
+            if metered and self.capture:
+                self.capture.log(name, log_record)
             mv = memoryview(log_record)
             if len(log_record) <= 8:
                 logger.warn('small shit', len=len(log_record), b64val=b64encode(log_record).decode())
@@ -157,6 +209,9 @@ class DockerManager():
             message = bytes(mv[8:]).decode('utf-8', 'replace')
             source = logs_sources.get(str(mv[0]), '')
             size = struct.unpack('>L', mv[4:8])[0]
+            if metered:
+                lines.inc()
+                nbytes.inc(size)
             
             msg = LogRecord(id, ts, cid, name, source, size, message)
             await channel.publish(msg)
@@ -174,6 +229,8 @@ class DockerManager():
             event = await subscriber.get()
             if event is None:
                 break
+            if self.capture:
+                self.capture.event(event)
             if event['Action'] != 'start' or event['Type'] != 'container':
                 continue
             # Not a band container
@@ -194,21 +251,47 @@ class DockerManager():
         if status:
             filters.status = [status]
         
-        containers = await self.dc.containers.list(all=True, filters=ujson.dumps(filters))
+        with DOCKER_LIST.time():
+            containers = await self.dc.containers.list(all=True, filters=ujson.dumps(filters))
         lst = []
         for c in containers:
-            bc = await BandContainer.create_with_info(c)
+            bc = BandContainer(c)
+            # list data is enough for most cases, inspect only on demand
+            if fullinfo:
+                with DOCKER_INSPECT.time():
+                    await bc.fill()
             lst.append(bc)
         
         return lst if not as_dict else {c.name: c for c in lst}
 
+    async def service_containers(self, name, fullinfo=False):
+        """
+        Containers of service: single one named after service or its replicas
+        """
+        containers = [c for c in await self.containers() if c.service == name]
+        if fullinfo:
+            for c in containers:
+                with DOCKER_INSPECT.time():
+                    await c.fill()
+        return sorted(containers, key=lambda c: c.replica or 0)
+
+    async def services_containers(self):
+        """
+        Containers grouped by service
+        """
+        groups = dict()
+        for c in await self.containers():
+            groups.setdefault(c.service, []).append(c)
+        return groups
+
     async def conts_list(self):
         cs = await self.containers()
         return [c.short_info for c in cs]
 
     async def get(self, name):
         try:
-            container = await self.dc.containers.get(name)
+            with DOCKER_GET.time():
+                container = await self.dc.containers.get(name)
             if container:
                 return BandContainer(container)
         except DockerError as e:
@@ -239,22 +322,36 @@ class DockerManager():
 
     def free_ports(self, ports):
         for port in ports:
-            self.reserved_ports.add(port)
+            self.reserved_ports.discard(port)
 
     async def remove_container(self, name):
+        """
+        Removes all containers of service
+        """
+        names = [c.name for c in await self.service_containers(name)] or [name]
+        for cname in names:
+            await self.__remove_container(cname)
+        return True
+
+    async def __remove_container(self, name):
         # removing if running
         try:
-            container = BandContainer(await self.dc.containers.get(name))
+            with DOCKER_GET.time():
+                container = BandContainer(await self.dc.containers.get(name))
             if container:
-                await container.fill()
-                if container.state == 'running':
+                with DOCKER_INSPECT.time():
+                    await container.fill()
+                if container.running:
                     container_autoremove = container.auto_removable()
                     logger.info("Stopping container")
-                    await container.stop()
+                    with DOCKER_STOP.time():
+                        await container.stop()
                     if not container_autoremove:
-                        await container.delete()
+                        with DOCKER_DELETE.time():
+                            await container.delete()
                 else:
-                    await container.delete()
+                    with DOCKER_DELETE.time():
+                        await container.delete()
                 
                 await asyncio.sleep(0.5)
                 # try:
@@ -272,36 +369,44 @@ class DockerManager():
         return True
 
     async def stop_container(self, name):
-        conts = await self.containers(as_dict=True)
-        if name in conts.keys():
-            c = conts[name]
+        conts = await self.service_containers(name)
+        for c in conts:
             logger.info(f"stopping container {c.name}")
-            await c.stop()
-            return True
+            with DOCKER_STOP.time():
+                await c.stop()
+        return bool(conts) or None
 
     async def start_container(self, name):
-        conts = await self.containers(as_dict=True)
-        if name in conts.keys():
-            c = conts[name]
+        conts = await self.service_containers(name)
+        for c in conts:
             logger.info(f"starting container {c.name}")
-            await c.start()
-            return True
+            with DOCKER_START.time():
+                await c.start()
+        return bool(conts) or None
 
     async def restart_container(self, name):
-        conts = await self.containers(as_dict=True)
-        if name in conts.keys():
-            c = conts[name]
+        conts = await self.service_containers(name)
+        for c in conts:
             logger.info(f"restarting container {c.name}")
-            await c.restart()
-            return True
+            with tracer.span(name, 'containers_restart'), DOCKER_RESTART.time():
+                await c.restart()
+        return bool(conts) or None
 
     async def create_image(self, img, img_options):
         logger.debug("Building image", n=img.name, io=img_options, path=img.path)
+        name = img.key or img.name
+        # same clock as tracer spans
+        build_started = perf_counter()
+        context_sent = False
         async with img.create(img_options) as builder:
             progress = pdict()
             struct = builder.struct()
             last_time = time()
             async for chunk in self.dc.images.build(**struct):
+                if not context_sent:
+                    # docker answers after whole context received
+                    context_sent = True
+                    tracer.record(name, 'context_upload', perf_counter() - build_started)
                 if isinstance(chunk, dict):
                     if chunk.get('aux'):
                         struct.id = chunk.get('aux').get('ID')
@@ -323,51 +428,187 @@ class DockerManager():
             if not struct.id:
                 raise Exception('Build process not completed')
             logger.info('Docker image created', struct_id=struct.id)
-            return img.set_data(await self.dc.images.get(img.name))
-
-    async def run_container(self, name, env={}, nocache=None, auto_remove=None, **kwargs):
-
+            with DOCKER_IMAGE_INSPECT.time():
+                img.set_data(await self.dc.images.get(img.name))
+            duration = perf_counter() - build_started
+            tracer.record(name, 'build', duration)
+            DOCKER_BUILD.observe(duration)
+            return img
+
+    async def load_image(self, img):
+        """
+        Fill image data from already built image, returns None if image absent
+        """
+        try:
+            with DOCKER_IMAGE_INSPECT.time():
+                return img.set_data(await self.dc.images.get(img.name))
+        except DockerError as exc:
+            if exc.status != 404:
+                raise exc
+
+    async def images_labels(self):
+        """
+        Built images ids and labels by single request: name -> (id, labels)
+        """
+        with DOCKER_IMAGE_LIST.time():
+            images = await self.dc.images.list()
+        res = {}
+        for image in images:
+            for tag in image.get('RepoTags') or []:
+                if tag.endswith(':latest'):
+                    tag = tag[:-len(':latest')]
+                res[tag] = (image['Id'], image.get('Labels') or {})
+        return res
+
+    async def prune_images(self, keep=IMAGES_KEEP, slot=None):
+        """
+        Removes director built images except last `keep` per name and
+        images used by any container, then other dangling images.
+        slot - async context manager factory guarding each removal.
+        Returns report with reclaimed space
+        """
+        report = pdict(removed=[], reclaimed=0, errors=[])
+        with DOCKER_LIST.time():
+            containers = await self.dc.containers.list(all=True)
+        used = set(c._container.get('ImageID') for c in containers)
+        with DOCKER_IMAGE_LIST.time():
+            # intermediate images included, parents sizes are required
+            sizes = {i['Id']: i for i in await self.dc.images.list(all=True)}
+        with DOCKER_IMAGE_LIST.time():
+            images = await self.dc.images.list(
+                all=False, filters=ujson.dumps({'label': [IMAGE_LABEL]}))
+        by_name = {}
+        for image in images:
+            name = (image.get('Labels') or {}).get(IMAGE_LABEL)
+            by_name.setdefault(name, []).append(image)
+        for name, versions in by_name.items():
+            versions.sort(key=lambda i: i['Created'], reverse=True)
+            for image in versions[keep:]:
+                if image['Id'] in used or image.get('RepoTags') not in (None, [], ['<none>:<none>']):
+                    continue
+                await self.__delete_image(image['Id'], name, sizes, report, slot)
+        # dangling images not built by director, retained versions are labeled
+        with DOCKER_PRUNE.time():
+            with DOCKER_IMAGE_LIST.time():
+                dangling = await self.dc.images.list(
+                    all=False, filters=ujson.dumps({'dangling': ['true']}))
+            for image in dangling:
+                if image['Id'] in used or IMAGE_LABEL in (image.get('Labels') or {}):
+                    continue
+                await self.__delete_image(image['Id'], None, sizes, report, slot)
+        metrics.images_reclaimed.inc(report.reclaimed)
+        logger.info('images pruned', removed=len(report.removed), reclaimed=report.reclaimed,
+                    errors=len(report.errors))
+        return report
+
+    async def __delete_image(self, image_id, name, sizes, report, slot=None):
+        try:
+            async with (slot or no_slot)():
+                with DOCKER_IMAGE_DELETE.time():
+                    deleted = await self.dc.images.delete(image_id)
+        except DockerError as exc:
+            # referenced by other image or container created meanwhile
+            report.errors.append(dict(id=image_id, error=exc.message))
+            return
+        report.removed.append(dict(name=name, id=image_id))
+        # image Size includes layers shared with parent, counting own layers only,
+        # images with unknown parent counted fully. Untagged parents removed
+        # along are separate entries
+        for entry in deleted or []:
+            removed = sizes.get(entry.get('Deleted'))
+            if removed:
+                parent = sizes.get(removed.get('ParentId')) or {}
+                report.reclaimed += max(0, removed.get('Size', 0) - parent.get('Size', 0))
+
+    async def image_id(self, name):
+        img = self.image_navigator[name]
+        if img and await self.load_image(img):
+            return img.id
+
+    def container_env(self, env):
+        """
+        Effective container environment: common params overridden by service env
+        """
+        return {**(self.container_params.get('env') or {}), **env}
+
+    def config_hash(self, image_id, env):
+        return config_hash(image_id, self.container_env(env))
+
+    async def build_image(self, name, nocache=None, **kwargs):
         image_options = dict(
             nocache=def_val(nocache, False),
             **self.image_params
         )
+        service_img = self.image_navigator[name]
+        logger.info('Building image', name=name, image_options=image_options)
+        return await self.create_image(service_img, image_options)
+
+    async def run_container(self, name, env={}, nocache=None, auto_remove=None, build=True,
+                            replicas=None, **kwargs):
+        """
+        Runs service container, or `replicas` containers named name-1..N
+        """
+
         container_options = dict(auto_remove=def_val(auto_remove, False))
 
         logger.info('called run container (kwargs will not used)', env=env,
-                    func_args=dict(auto_remove=auto_remove, nocache=nocache, kwargs=kwargs), image_options=image_options, container_options=container_options)
+                    func_args=dict(auto_remove=auto_remove, nocache=nocache, kwargs=kwargs), container_options=container_options)
 
-        # building image
         service_img = self.image_navigator[name]
 
-        logger.info('Building image', name=name)
-        await self.create_image(service_img, image_options)
+        # building image
+        if build or not await self.load_image(service_img):
+            await self.build_image(name, nocache=nocache)
         logger.info('Removing active container', name=name)
-        
-        await self.remove_container(name)
-        await asyncio.sleep(0.1)
+
+        with tracer.span(name, 'remove_container'):
+            await self.remove_container(name)
+            await asyncio.sleep(0.1)
         # preparing to run
-        available_ports = await self.available_ports()
-        allocated_ports = list(available_ports.pop()
-                               for p in service_img.ports)
-        self.hold_ports(allocated_ports)
+        with tracer.span(name, 'available_ports'):
+            available_ports = await self.available_ports()
+        names = replica_names(name, replicas)
+        # separate host ports for each replica
+        allocated = [list(available_ports.pop() for p in service_img.ports) for _ in names]
+        for ports in allocated:
+            self.hold_ports(ports)
+        created = []
         try:
-            params = pdict.from_dict({
-                **dict(host_ports=allocated_ports),
-                **self.container_params})
-            params.env.update(env)
             builder = BandContainerBuilder(service_img)
-            config = builder.run_struct(name, **container_options, **params)
-            # running service
-            logger.info(f"starting container {name}.")
-            dc = await self.dc.containers.run(config=config, name=name)
-            c = BandContainer(dc)
-            await c.ensure_filled()
-            logger.info(f'started container {c.name} [{c.short_id}] {c.ports}')
-            return c.short_info
-        except Exception as exc:
-            raise exc
+            infos = []
+            for replica, (cname, ports) in enumerate(zip(names, allocated), 1):
+                # container could exist even if run failed at start
+                created.append(cname)
+                params = pdict.from_dict({
+                    **dict(host_ports=ports),
+                    **self.container_params})
+                params.env.update(env)
+                params.config_hash = config_hash(service_img.id, params.env)
+                if len(names) > 1:
+                    params.replica = replica
+                config = builder.run_struct(name, **container_options, **params)
+                # running service
+                logger.info(f"starting container {cname}.")
+                with tracer.span(name, 'containers_run'), DOCKER_RUN.time():
+                    dc = await self.dc.containers.run(config=config, name=cname)
+                    c = BandContainer(dc)
+                    await c.ensure_filled()
+                logger.info(f'started container {c.name} [{c.short_id}] {c.ports}')
+                infos.append(c.short_info)
+            return infos[0] if len(infos) == 1 else infos
+        except Exception:
+            if len(names) > 1:
+                # partial replica set is not left running
+                logger.warn('replica failed, removing created ones', name=name, created=created)
+                for cname in created:
+                    try:
+                        await self.__remove_container(cname)
+                    except Exception:
+                        logger.exception('replica cleanup', container=cname)
+            raise
         finally:
-            self.free_ports(allocated_ports)
+            for ports in allocated:
+                self.free_ports(ports)
 
     async def close(self):
         await self.dc.close()
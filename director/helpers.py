@@ -1,5 +1,12 @@
+import ujson
+from hashlib import sha1
 from inflection import underscore
 from prodict import Prodict
+from time import time
+
+# process boot id. sequences and versions restart from zero with process,
+# clients holding cursors of previous process should detect it
+BOOT_ID = format(int(time() * 1000), 'x')
 
 
 def def_val(val, def_val):
@@ -71,3 +78,19 @@ def merge_dicts(*args):
     for d2 in args[1:]:
         d.update(d2)
     return d
+
+
+def config_hash(image_id, env):
+    """
+    Fingerprint of image and container environment.
+    Stored as container label to detect configuration drift
+    """
+    env_line = ujson.dumps(sorted((str(k), str(v)) for k, v in env.items()))
+    return sha1(f'{image_id}|{env_line}'.encode()).hexdigest()
+
+
+def stable_hash(obj):
+    """
+    Hash that persists between process restarts unlike builtin hash()
+    """
+    return sha1(ujson.dumps(obj, sort_keys=True).encode()).hexdigest()
@@ -0,0 +1,172 @@
+"""
+Service metadata indexer.
+Collects band.service.* labels of built images, image Dockerfile and
+descriptor file at image source directory.
+"""
+import asyncio
+import os
+import shlex
+import yaml
+from prodict import Prodict as pdict
+
+from .constants import DEFAULT_DOCKERFILE, META_LABEL_PREFIX, META_DESCRIPTOR
+
+FLAGS = ('protected', 'persistent', 'native')
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ('yes', 'true', 't', '1')
+
+
+def parse_pos(value):
+    if isinstance(value, dict):
+        value = f"{value.get('col')}x{value.get('row')}"
+    try:
+        col, row = str(value).split('x')
+        return dict(col=int(col), row=int(row))
+    except ValueError:
+        pass
+
+
+def normalize(fields):
+    """
+    Converts descriptor fields or labels without prefix to service meta
+    """
+    meta = {}
+    for key, value in fields.items():
+        if key.startswith('env.'):
+            meta.setdefault('env', {})[key[4:]] = str(value)
+        elif key == 'env' and isinstance(value, dict):
+            meta.setdefault('env', {}).update({k: str(v) for k, v in value.items()})
+        elif key in ('def_position', 'pos'):
+            pos = parse_pos(value)
+            if pos:
+                meta['pos'] = pos
+        elif key in FLAGS:
+            meta[key] = to_bool(value)
+        else:
+            meta[key] = value
+    return meta
+
+
+def labels_meta(labels):
+    return normalize({
+        k[len(META_LABEL_PREFIX):]: v
+        for k, v in (labels or {}).items() if k.startswith(META_LABEL_PREFIX)})
+
+
+def merge_meta(*metas):
+    result = {}
+    for meta in metas:
+        for key, value in meta.items():
+            if key == 'env':
+                result.setdefault('env', {}).update(value)
+            else:
+                result[key] = value
+    return result
+
+
+def dockerfile_labels(path):
+    """
+    Labels defined by LABEL instructions of Dockerfile
+    """
+    labels = {}
+    with open(path) as f:
+        content = f.read().replace('\\\n', ' ')
+    for line in content.splitlines():
+        line = line.strip()
+        if line[:6].upper() != 'LABEL ':
+            continue
+        try:
+            tokens = shlex.split(line[6:])
+        except ValueError:
+            continue
+        if tokens and '=' not in tokens[0]:
+            # legacy form: LABEL key value
+            labels[tokens[0]] = ' '.join(tokens[1:])
+            continue
+        for token in tokens:
+            if '=' in token:
+                key, value = token.split('=', 1)
+                labels[key] = value
+    return labels
+
+
+def source_files(path):
+    return os.path.join(path, DEFAULT_DOCKERFILE), os.path.join(path, META_DESCRIPTOR)
+
+
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        pass
+
+
+def sources_mtimes(paths):
+    """
+    Content mtimes of image sources. Runs in executor
+    """
+    return [tuple(map(file_mtime, source_files(path))) for path in paths]
+
+
+def sources_meta(paths):
+    """
+    Parses image sources meta. Runs in executor
+    """
+    res = []
+    for path in paths:
+        dockerfile, descriptor = source_files(path)
+        meta = {}
+        if os.path.isfile(dockerfile):
+            meta = labels_meta(dockerfile_labels(dockerfile))
+        if os.path.isfile(descriptor):
+            with open(descriptor) as f:
+                meta = merge_meta(meta, normalize(yaml.safe_load(f) or {}))
+        res.append(meta)
+    return res
+
+
+class MetaIndexer:
+    """
+    Keeps parsed meta cached by sources mtimes and built image id
+    """
+
+    def __init__(self):
+        # path -> (mtimes, meta)
+        self._sources = {}
+        # image id -> meta
+        self._built = {}
+
+    async def index(self, images, built):
+        """
+        Returns meta for each image. built maps image tag to (image id, labels)
+        """
+        loop = asyncio.get_event_loop()
+        paths = [img.path for img in images]
+        mtimes = await loop.run_in_executor(None, sources_mtimes, paths)
+        changed = [
+            (path, m) for path, m in zip(paths, mtimes)
+            if path not in self._sources or self._sources[path][0] != m]
+        if changed:
+            metas = await loop.run_in_executor(None, sources_meta, [c[0] for c in changed])
+            for (path, m), meta in zip(changed, metas):
+                self._sources[path] = (m, meta)
+        self._sources = {path: self._sources[path] for path in paths}
+
+        built_cache = {}
+        result = []
+        for img in images:
+            image_meta = {}
+            image_id, labels = built.get(img.name) or (None, None)
+            if image_id:
+                image_meta = self._built.get(image_id)
+                if image_meta is None:
+                    image_meta = labels_meta(labels)
+                built_cache[image_id] = image_meta
+            # sources are newer than built image
+            result.append(pdict.from_dict(merge_meta(image_meta, self._sources[img.path][1])))
+        self._built = built_cache
+        return result
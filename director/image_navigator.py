@@ -1,3 +1,4 @@
+import asyncio
 import aiofiles
 import yaml
 import stat
@@ -6,6 +7,42 @@ from aiofiles import os as aios
 from collections import UserDict
 from prodict import Prodict as pdict
 from .band_image import BandImage
+from .image_meta import MetaIndexer
+
+
+def dir_mtime(path):
+    return os.stat(path).st_mtime_ns
+
+
+def source_fingerprint(path):
+    """
+    Changes when any file of image source added, removed or modified. Runs in executor
+    """
+    latest, files = 0, 0
+    for root, dirs, names in os.walk(path):
+        dirs[:] = [d for d in dirs if d != '.git']
+        # directory mtime reflects removed files
+        latest = max(latest, os.stat(root).st_mtime_ns)
+        for name in names:
+            try:
+                latest = max(latest, os.lstat(os.path.join(root, name)).st_mtime_ns)
+            except FileNotFoundError:
+                continue
+            files += 1
+    return f'{latest}-{files}'
+
+
+def scan_collection(path):
+    """
+    Lists image sources at collection directory. Runs in executor
+    """
+    res = []
+    with os.scandir(path) as it:
+        for entry in it:
+            bn = entry.name
+            if entry.is_dir() and not bn.startswith('__') and not bn.startswith('.'):
+                res.append((os.path.realpath(entry.path), bn))
+    return sorted(res, key=lambda r: r[1])
 
 
 class ImageNavigator():
@@ -27,6 +64,11 @@ class ImageNavigator():
     def __init__(self, images, *args, **kwargs):
         self._imgconfig = images
         self._images = {}
+        # config item index -> (dir mtime, images)
+        self._sources = {}
+        self._version = 0
+        self._list = (None, [])
+        self.indexer = MetaIndexer()
 
     def __getattr__(self, key):
         return self.__getitem__(key)
@@ -40,52 +82,110 @@ class ImageNavigator():
     def is_native(self, name):
         return name in self._images
 
+    @property
+    def version(self):
+        return self._version
+
     async def load(self):
-        self._images = {}
-        for item in self._imgconfig:
+        """
+        Refreshes catalogue. Collection rescanned only if its directory mtime changed
+        """
+        loop = asyncio.get_event_loop()
+        changed = False
+        for idx, item in enumerate(self._imgconfig):
             item = {**item}
             collection = item.pop('collection', None)
+            source = self._sources.get(idx)
             if collection == True:
-                for img in await self.__handle_collection(**item):
-                    await self.__add_image(**img)
+                mtime = await loop.run_in_executor(None, dir_mtime, item['path'])
+                if source and source[0] == mtime:
+                    continue
+                images = await self.__handle_collection(
+                    previous=source[1] if source else {}, **item)
+            elif source:
+                continue
             else:
-                await self.__add_image(**item)
+                mtime = None
+                images = await self.__handle_image(**item)
+            self._sources[idx] = (mtime, images)
+            changed = True
+        if changed:
+            self.__reindex()
+
+    def __reindex(self):
+        images = {}
+        for idx in sorted(self._sources):
+            for img in self._sources[idx][1].values():
+                images[img.name] = img
+                if img.key:
+                    images[img.key] = img
+        if images.keys() != self._images.keys() or any(
+                images[k] is not self._images[k] for k in images):
+            self._version += 1
+        self._images = images
+
+
+    async def index_meta(self, built):
+        """
+        Refreshes images meta. built maps image tag to (image id, labels).
+        Returns service keys of images with changed meta
+        """
+        images = [i for k, i in self._images.items() if i.name == k]
+        metas = await self.indexer.index(images, built)
+        changed = []
+        for img, meta in zip(images, metas):
+            if meta != img.meta:
+                img.meta = meta
+                changed.append(img.key or img.name)
+        if changed:
+            self._version += 1
+        return changed
+
+    async def fingerprints(self):
+        """
+        Source fingerprints of all images by service key
+        """
+        images = [i for k, i in self._images.items() if i.name == k]
+        prints = await asyncio.get_event_loop().run_in_executor(
+            None, lambda: [source_fingerprint(img.path) for img in images])
+        return {img.key or img.name: fp for img, fp in zip(images, prints)}
 
+    async def fingerprint(self, name):
+        img = self[name]
+        if img:
+            return await asyncio.get_event_loop().run_in_executor(
+                None, source_fingerprint, img.path)
 
     async def image_meta(self, name):
         if name in self._images:
             return self[name].get('meta', None)
 
-    async def __handle_collection(self, **kwargs):
+    async def __handle_collection(self, previous, **kwargs):
         prefix = kwargs.pop('prefix')
         path = kwargs.pop('path')
-        res = []
-        for d in os.listdir(path):
-            item = await self.__check_source(os.path.join(path, d))
-            if item:
-                p, bn = item
-                img = dict(name=prefix + bn, path=p, key=d, **kwargs)
-                res.append(img)
+        loop = asyncio.get_event_loop()
+        res = {}
+        for p, bn in await loop.run_in_executor(None, scan_collection, path):
+            name = prefix + bn
+            img = previous.get(name)
+            # unchanged entries are kept as is
+            if not img or img.path != p:
+                img = BandImage(name=name, path=p, key=bn, meta={}, **kwargs)
+            res[name] = img
         return res
 
-    async def __add_image(self, name, path, **kwargs):
-        path = os.path.realpath(path)
-        meta = {}
+    async def __handle_image(self, name, path, **kwargs):
+        loop = asyncio.get_event_loop()
+        path = await loop.run_in_executor(None, os.path.realpath, path)
         key = kwargs.pop('key', None)
-        img = BandImage(name=name, path=path, key=key, meta=meta, **kwargs)
-        self._images[name] = img
-        if key:
-            self._images[key] = img
-
-    async def __check_source(self, path):
-        st = await aios.stat(path)
-        bn = os.path.basename(path)
-        if stat.S_ISDIR(st.st_mode):
-            if not bn.startswith('__') and not bn.startswith('.'):
-                return (path, bn)
+        return {name: BandImage(name=name, path=path, key=key, meta={}, **kwargs)}
 
     async def lst(self):
         await self.load()
-        # handle hidden images, and base without key
-        return list(
-            i for k, i in self._images.items() if i.name == k and i.key)
+        version, images = self._list
+        if version != self._version:
+            # handle hidden images, and base without key
+            images = list(
+                i for k, i in self._images.items() if i.name == k and i.key)
+            self._list = (self._version, images)
+        return images
@@ -0,0 +1,88 @@
+"""
+Compact capture of raw docker log frames and events.
+
+File is sequence of records:
+    kind (1 byte), unix time (double), name length (2 bytes), payload length (4 bytes),
+    name, payload
+Log records carry raw multiplexed frame, event records carry json.
+"""
+import asyncio
+import os
+import struct
+import ujson
+from time import time
+from band import logger
+
+RECORD_LOG = 1
+RECORD_EVENT = 2
+HEADER = struct.Struct('>BdHI')
+FLUSH_SIZE = 1 << 16
+
+
+def pack(kind, ts, name, payload):
+    name = name.encode()
+    return HEADER.pack(kind, ts, len(name), len(payload)) + name + payload
+
+
+def read_capture(path):
+    """
+    Yields (kind, ts, name, payload) records of capture file
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            kind, ts, name_len, payload_len = HEADER.unpack(header)
+            name = f.read(name_len).decode()
+            yield kind, ts, name, f.read(payload_len)
+
+
+class LogCapture:
+    """
+    Buffers records in memory, file writes done off the event loop
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.buffer = bytearray()
+        self.records = 0
+        self._file = None
+
+    async def open(self):
+        self._file = await asyncio.get_event_loop().run_in_executor(None, self._open)
+        return self
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        return open(self.path, 'ab')
+
+    def log(self, name, frame):
+        self.add(RECORD_LOG, name, bytes(frame))
+
+    def event(self, event):
+        self.add(RECORD_EVENT, event.get('Actor', {}).get('Attributes', {}).get('name', ''),
+                 ujson.dumps(event).encode())
+
+    def add(self, kind, name, payload):
+        self.buffer += pack(kind, time(), name, payload)
+        self.records += 1
+        if len(self.buffer) >= FLUSH_SIZE:
+            asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        if not self.buffer or not self._file:
+            return
+        data, self.buffer = bytes(self.buffer), bytearray()
+        await asyncio.get_event_loop().run_in_executor(None, self._write, data)
+
+    def _write(self, data):
+        self._file.write(data)
+        self._file.flush()
+
+    async def close(self):
+        await self.flush()
+        if self._file:
+            await asyncio.get_event_loop().run_in_executor(None, self._file.close)
+        self._file = None
+        logger.info('log capture closed', path=self.path, records=self.records)
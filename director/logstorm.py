@@ -0,0 +1,200 @@
+"""
+Log pipeline load generator.
+Replays captured log streams or synthesizes storms and pushes them through
+DockerManager.logs_reader -> own channel -> websocket.ws_sender with simulated
+websocket clients, then reports delivery latency, drops and process RSS.
+"""
+import asyncio
+import os
+import random
+import resource
+import struct
+from time import time
+from aiodocker.channel import Channel
+from band import logger, scheduler
+
+from .log_capture import read_capture, RECORD_LOG
+from .tracing import percentile
+
+STORM_MARK = 'storm '
+TICK = 0.01
+
+
+def rss_bytes():
+    """
+    Current resident set size, falls back to peak when /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def marked_frame(body, stream=1):
+    """
+    Multiplexed frame with payload prefixed by generation time
+    """
+    payload = f'{STORM_MARK}{time():.6f} '.encode() + body
+    return struct.pack('>BxxxL', stream, len(payload)) + payload
+
+
+def storm_frame(size):
+    return marked_frame(b'x' * max(size - 1, 0) + b'\n')
+
+
+def parse_sizes(spec):
+    """
+    Line size distribution "80:0.7,400:0.25,4000:0.05" to (sizes, weights)
+    """
+    sizes, weights = [], []
+    for part in spec.split(','):
+        size, _, weight = part.partition(':')
+        sizes.append(int(size))
+        weights.append(float(weight or 1))
+    return sizes, weights
+
+
+class ReplayLogs:
+    """
+    Stands for container logs reader: same subscribe/run interface fed by generator
+    """
+
+    def __init__(self, frames):
+        self.channel = Channel()
+        self.frames = frames
+        self.sent = 0
+
+    def subscribe(self):
+        return self.channel.subscribe()
+
+    async def run(self, **params):
+        async for frame in self.frames:
+            await self.channel.publish(frame)
+            self.sent += 1
+        await self.channel.publish(None)
+
+
+class ReplayContainer:
+    def __init__(self, frames):
+        self.logs = ReplayLogs(frames)
+
+
+async def storm_frames(rate, seconds, sizes, weights):
+    deadline = time() + seconds
+    per_tick = rate * TICK
+    debt = 0
+    while time() < deadline:
+        debt += per_tick
+        amount = int(debt)
+        debt -= amount
+        for size in random.choices(sizes, weights, k=amount):
+            yield storm_frame(size)
+        await asyncio.sleep(TICK)
+
+
+async def replay_frames(records, speed):
+    """
+    Captured frames with original timing divided by speed.
+    Generation time mark is prepended to payload to measure delivery latency
+    """
+    started = time()
+    first_ts = None
+    for ts, frame in records:
+        first_ts = first_ts or ts
+        delay = (ts - first_ts) / speed - (time() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        yield marked_frame(frame[8:], stream=frame[0])
+
+
+class FakeWebSocket:
+    """
+    Simulated websocket client measuring delivery latency
+    """
+
+    def __init__(self):
+        self.received = 0
+        self.latencies = []
+
+    async def send_str(self, data):
+        self.received += 1
+        pos = data.find(STORM_MARK)
+        if pos >= 0:
+            start = pos + len(STORM_MARK)
+            self.latencies.append(time() - float(data[start:data.find(' ', start)]))
+
+
+class LogStorm:
+    def __init__(self, dock, ws_sender, clients=1):
+        self.dock = dock
+        self.ws_sender = ws_sender
+        self.clients = [FakeWebSocket() for _ in range(clients)]
+        # isolated from production logs channel, real clients and logs service
+        self.channel = Channel()
+
+    async def run(self, streams, drain=5):
+        """
+        streams - mapping container name to frames async generator
+        """
+        rss_before = rss_bytes()
+        senders = [
+            await scheduler.spawn(self.ws_sender(
+                ws, subscription=self.channel.subscribe(), notify=False))
+            for ws in self.clients]
+        containers = {name: ReplayContainer(frames) for name, frames in streams.items()}
+        started = time()
+        await asyncio.gather(*[
+            self.dock.logs_reader(
+                self.dock.dc, c, self.channel, name, f'storm-{name}', metered=False)
+            for name, c in containers.items()])
+        generated = sum(c.logs.sent for c in containers.values())
+        # waiting for delivery
+        deadline = time() + drain
+        while time() < deadline and any(ws.received < generated for ws in self.clients):
+            await asyncio.sleep(0.05)
+        elapsed = time() - started
+        rss_after = rss_bytes()
+        for sender in senders:
+            await sender.close()
+        latencies = sorted(l for ws in self.clients for l in ws.latencies)
+        report = dict(
+            containers=len(containers),
+            clients=len(self.clients),
+            generated=generated,
+            seconds=elapsed,
+            lines_per_sec=generated / elapsed if elapsed else 0,
+            delivered=[ws.received for ws in self.clients],
+            drops=sum(max(generated - ws.received, 0) for ws in self.clients),
+            latency=dict(
+                p50=percentile(latencies, 0.5),
+                p95=percentile(latencies, 0.95),
+                p99=percentile(latencies, 0.99),
+                max=latencies[-1] if latencies else None),
+            rss_before=rss_before,
+            rss_after=rss_after)
+        logger.info('log storm finished', report=report)
+        return report
+
+    async def storm(self, containers=10, rate=100, seconds=10, sizes='120:1', **kwargs):
+        """
+        N containers x M lines/sec with line size distribution
+        """
+        sizes, weights = parse_sizes(sizes)
+        return await self.run({
+            f'storm{i}': storm_frames(rate, seconds, sizes, weights) for i in range(containers)
+        }, **kwargs)
+
+    async def replay(self, path, speed=1, **kwargs):
+        """
+        Replay capture file at speed multiplier
+        """
+        loop = asyncio.get_event_loop()
+        records = dict()
+        captured = await loop.run_in_executor(None, lambda: list(read_capture(path)))
+        for kind, ts, name, payload in captured:
+            if kind == RECORD_LOG:
+                records.setdefault(name, []).append((ts, payload))
+        return await self.run({
+            name: replay_frames(recs, speed) for name, recs in records.items()
+        }, **kwargs)
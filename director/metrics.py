@@ -0,0 +1,193 @@
+"""
+Director internals metrics in prometheus text exposition format.
+Label children are allocated once and cached, hot paths only touch counters
+"""
+from bisect import bisect_left
+from time import perf_counter
+
+DEFAULT_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def label_str(names, values, extra=''):
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Timer:
+    __slots__ = ('child', 'started')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.child.observe(perf_counter() - self.started)
+
+
+class CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class GaugeChild(CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return Timer(self)
+
+
+class Metric:
+    kind = None
+    child_class = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        self.children = dict()
+        registry.append(self)
+
+    def make_child(self):
+        return self.child_class()
+
+    def labels(self, *values):
+        """
+        Returns child for label values. Keep reference to child on hot paths
+        """
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.make_child()
+        return child
+
+    def remove(self, *values):
+        self.children.pop(values, None)
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            yield self.name, label_str(self.label_names, values), child.value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.kind}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{labels} {value}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+    child_class = CounterChild
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+    child_class = GaugeChild
+
+
+class CallbackGauge(Metric):
+    """
+    Gauge evaluated at scrape time. Callback returns mapping label values tuple to value
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, doc, callback, labels=()):
+        super().__init__(name, doc, labels)
+        self.callback = callback
+
+    def samples(self):
+        for values, value in self.callback().items():
+            yield self.name, label_str(self.label_names, values), value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def make_child(self):
+        return HistogramChild(self.buckets)
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), child.counts):
+                cumulative += count
+                yield (f'{self.name}_bucket',
+                       label_str(self.label_names, values, f'le="{bound}"'), cumulative)
+            yield f'{self.name}_sum', label_str(self.label_names, values), child.sum
+            yield f'{self.name}_count', label_str(self.label_names, values), child.count
+
+
+registry = []
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+docker_api = Histogram(
+    'director_docker_api_seconds', 'Docker API calls latency', labels=('op',))
+redis_cmd = Histogram(
+    'director_redis_command_seconds', 'Redis commands latency', labels=('cmd',))
+rpc_request = Histogram(
+    'director_rpc_request_seconds', 'Band RPC requests latency', labels=('method',))
+rpc_timeouts = Counter(
+    'director_rpc_timeouts_total', 'Band RPC requests without response', labels=('method',))
+clean_cycle = Histogram(
+    'director_clean_worker_cycle_seconds', 'State clean worker cycle duration').labels()
+log_lines = Counter(
+    'director_log_lines_total', 'Container log lines received', labels=('container',))
+log_bytes = Counter(
+    'director_log_bytes_total', 'Container log bytes received', labels=('container',))
+ws_clients = Gauge(
+    'director_websocket_clients', 'Connected websocket clients').labels()
+images_reclaimed = Counter(
+    'director_images_reclaimed_bytes_total', 'Disk space reclaimed by images pruning').labels()
+config_cache = Counter(
+    'director_config_cache_total', 'Config cache lookups', labels=('result',))
+config_flush = Histogram(
+    'director_config_flush_seconds', 'Buffered config writes flush duration').labels()
+config_flush_batch = Histogram(
+    'director_config_flush_batch', 'Buffered config writes per flush',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)).labels()
+clickhouse_query = Histogram(
+    'director_clickhouse_query_seconds', 'ClickHouse queries latency', labels=('query',))
@@ -0,0 +1,140 @@
+"""
+On-demand diagnostics: allocations tracing, asyncio tasks dump, sampling profiler
+"""
+import asyncio
+import os
+import sys
+import threading
+import tracemalloc
+from collections import Counter, defaultdict
+from time import perf_counter, sleep
+
+MAX_PROFILE_SECONDS = 60
+
+
+def frame_key(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+def collapsed_stack(frame):
+    keys = []
+    while frame:
+        keys.append(frame_key(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(keys))
+
+
+def sample_thread(thread_id, seconds, interval):
+    """
+    Samples stacks of thread. Returns collapsed stacks counter
+    """
+    stacks = Counter()
+    deadline = perf_counter() + min(seconds, MAX_PROFILE_SECONDS)
+    while perf_counter() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame:
+            stacks[collapsed_stack(frame)] += 1
+        sleep(interval)
+    return stacks
+
+
+async def profile_loop(seconds=5, interval=0.005):
+    """
+    Sampling CPU profile of event loop thread in collapsed stack format
+    """
+    loop = asyncio.get_event_loop()
+    stacks = await loop.run_in_executor(
+        None, sample_thread, threading.get_ident(), seconds, interval)
+    return '\n'.join(f'{stack} {count}' for stack, count in stacks.most_common())
+
+
+def task_coro(task):
+    # Task.get_coro() appeared in python 3.8
+    get_coro = getattr(task, 'get_coro', None)
+    return get_coro() if get_coro else getattr(task, '_coro', None)
+
+
+def coro_name(task):
+    coro = task_coro(task)
+    return getattr(coro, '__qualname__', None) or repr(coro)
+
+
+def task_stack(task, limit=20):
+    """
+    Await chain of suspended task, outermost first.
+    Frames of suspended coroutines are not linked by f_back
+    """
+    stack = []
+    coro = task_coro(task)
+    while coro is not None and len(stack) < limit:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        stack.append(f'{frame.f_code.co_filename}:{frame.f_lineno} {frame.f_code.co_name}')
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return stack
+
+
+def tasks_summary():
+    """
+    Live asyncio tasks grouped by coroutine name
+    """
+    groups = defaultdict(list)
+    for task in asyncio.all_tasks():
+        groups[coro_name(task)].append(task)
+    result = []
+    for name, tasks in groups.items():
+        result.append(dict(
+            coro=name,
+            count=len(tasks),
+            done=sum(1 for t in tasks if t.done()),
+            sample_stack=task_stack(tasks[0])))
+    return sorted(result, key=lambda g: g['count'], reverse=True)
+
+
+class MemoryTracer:
+    """
+    Wraps tracemalloc, keeps previous snapshot to compare with
+    """
+
+    def __init__(self):
+        self.snapshot = None
+
+    def start(self, nframes=1):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(nframes)
+        self.snapshot = None
+        return self.status()
+
+    def stop(self):
+        tracemalloc.stop()
+        self.snapshot = None
+        return self.status()
+
+    def status(self):
+        current, peak = tracemalloc.get_traced_memory()
+        return dict(tracing=tracemalloc.is_tracing(), current=current, peak=peak)
+
+    def diff(self, limit=30, key_type='lineno'):
+        """
+        Top allocation differences since previous call
+        """
+        if not tracemalloc.is_tracing():
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>')))
+        if self.snapshot:
+            stats = snapshot.compare_to(self.snapshot, key_type)
+            top = [dict(where=str(s.traceback), size=s.size, size_diff=s.size_diff,
+                        count=s.count, count_diff=s.count_diff) for s in stats[:limit]]
+        else:
+            stats = snapshot.statistics(key_type)
+            top = [dict(where=str(s.traceback), size=s.size, count=s.count)
+                   for s in stats[:limit]]
+        self.snapshot = snapshot
+        return dict(self.status(), top=top)
+
+
+memory_tracer = MemoryTracer()
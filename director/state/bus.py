@@ -0,0 +1,120 @@
+import asyncio
+from collections import deque
+from band import logger, loop
+
+from ..constants import STATE_BUS_HISTORY, STATE_BUS_QUEUE
+from ..helpers import BOOT_ID
+
+EVENT_STATE = 'state'
+EVENT_RESET = 'reset'
+EVENT_JOB = 'job'
+
+
+def plain_state(state):
+    """
+    Detached copy of service state suitable for later comparison
+    """
+    return {k: dict(v) if isinstance(v, dict) else v for k, v in state.items()}
+
+
+def state_diff(prev, current):
+    if not prev:
+        return current
+    return {k: v for k, v in current.items() if prev.get(k) != v}
+
+
+class StateSubscription:
+    def __init__(self, bus):
+        self.bus = bus
+        self.queue = asyncio.Queue(maxsize=STATE_BUS_QUEUE)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # slow client. dropping pending events and asking to resync
+            logger.warn('state subscriber overflow')
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(self.bus.reset_event())
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class StateBus:
+    """
+    Sequenced stream of services state changes.
+    Mutations marked during loop iteration are coalesced into single diff per service
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.seq = 0
+        self.history = deque(maxlen=STATE_BUS_HISTORY)
+        self.subscribers = set()
+        self._last = dict()
+        self._dirty = dict()
+        self._flush_scheduled = False
+
+    def mark(self, svc):
+        self._dirty[svc.name] = svc
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            loop.call_soon(self.flush)
+
+    def flush(self):
+        self._flush_scheduled = False
+        dirty, self._dirty = self._dirty, dict()
+        for name, svc in dirty.items():
+            current = plain_state(svc.full_state())
+            diff = state_diff(self._last.get(name), current)
+            if not diff:
+                continue
+            self._last[name] = current
+            self.publish(dict(type=EVENT_STATE, name=name, diff=diff))
+
+    def publish(self, event):
+        self.seq += 1
+        event['seq'] = self.seq
+        event['epoch'] = BOOT_ID
+        self.history.append(event)
+        for subscription in self.subscribers:
+            subscription.put(event)
+
+    def job_changed(self, job):
+        self.publish(dict(type=EVENT_JOB, job=job.as_dict()))
+
+    def reset_event(self):
+        """
+        Full state of all services. Sent when client can't be resumed from history
+        """
+        return dict(type=EVENT_RESET, seq=self.seq, epoch=BOOT_ID,
+                    items=self.manager.list_snapshot().items)
+
+    def backlog(self, since, epoch=None):
+        """
+        Events after since. Cursor of other process or from future gets reset
+        """
+        if since is None:
+            return []
+        if (epoch is not None and epoch != BOOT_ID) or since > self.seq:
+            return [self.reset_event()]
+        if since == self.seq:
+            return []
+        if not self.history or self.history[0]['seq'] > since + 1:
+            return [self.reset_event()]
+        return [e for e in self.history if e['seq'] > since]
+
+    def subscribe(self, since=None, epoch=None):
+        subscription = StateSubscription(self)
+        for event in self.backlog(since, epoch):
+            subscription.put(event)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
@@ -0,0 +1,228 @@
+import asyncio
+from collections import deque
+from time import time
+from band import logger
+
+from ..constants import (
+    PROBE_TICK, PROBE_WHEEL_SLOTS, PROBE_MIN_INTERVAL, PROBE_MAX_INTERVAL,
+    PROBE_STABLE_STREAK, PROBE_MAX_INFLIGHT, PROBE_SYNC_INTERVAL)
+
+HOUR = 3600
+DAY = 24 * HOUR
+EWMA_ALPHA = 0.2
+# single result covers at most this many probe intervals
+PROBE_GAP_FACTOR = 2
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel. Scheduling and cancelling are O(1),
+    single ticker serves all timers
+    """
+
+    def __init__(self, tick, slots):
+        self.tick = tick
+        self.slots = [dict() for _ in range(slots)]
+        self.position = 0
+        # key -> slot index
+        self.timers = dict()
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, key, delay):
+        self.cancel(key)
+        ticks = max(1, int(round(delay / self.tick)))
+        idx = (self.position + ticks) % len(self.slots)
+        # full turns to skip before firing
+        self.slots[idx][key] = (ticks - 1) // len(self.slots)
+        self.timers[key] = idx
+
+    def cancel(self, key):
+        idx = self.timers.pop(key, None)
+        if idx is not None:
+            self.slots[idx].pop(key, None)
+
+    def advance(self):
+        """
+        Moves to next slot, returns expired keys
+        """
+        self.position = (self.position + 1) % len(self.slots)
+        slot = self.slots[self.position]
+        due = []
+        for key, rounds in list(slot.items()):
+            if rounds:
+                slot[key] = rounds - 1
+            else:
+                due.append(key)
+                del slot[key]
+                del self.timers[key]
+        return due
+
+
+class ProbeStats:
+    """
+    Probe results of single service. Availability is time-weighted:
+    each result covers time since previous probe, accumulated in per-minute buckets
+    """
+    __slots__ = ('interval', 'streak', 'failures', 'ratio', 'latency', 'buckets',
+                 'day_up', 'day_total', 'last')
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.streak = 0
+        self.failures = 0
+        self.ratio = None
+        self.latency = None
+        # [minute, up seconds, observed seconds]
+        self.buckets = deque()
+        self.day_up = 0
+        self.day_total = 0
+        self.last = None
+
+    def __account(self, ok, start, end):
+        while start < end:
+            minute = int(start // 60)
+            span = min(end, (minute + 1) * 60) - start
+            if not self.buckets or self.buckets[-1][0] != minute:
+                self.buckets.append([minute, 0, 0])
+            bucket = self.buckets[-1]
+            bucket[1] += span * ok
+            bucket[2] += span
+            self.day_up += span * ok
+            self.day_total += span
+            start += span
+
+    def record(self, ok, latency, now):
+        # result stands for period since previous probe, gaps longer than
+        # expected (prober stopped, service inactive) are not observed
+        covered = self.interval * PROBE_GAP_FACTOR
+        elapsed = covered if self.last is None else min(now - self.last, covered)
+        self.__account(ok, now - elapsed, now)
+        # running day totals, evicting expired minutes
+        while self.buckets and self.buckets[0][0] <= int(now // 60) - DAY // 60:
+            _, old_up, old_total = self.buckets.popleft()
+            self.day_up -= old_up
+            self.day_total -= old_total
+        self.ratio = ok if self.ratio is None else (
+            EWMA_ALPHA * ok + (1 - EWMA_ALPHA) * self.ratio)
+        if ok:
+            self.latency = latency if self.latency is None else (
+                EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency)
+        self.last = now
+
+    def availability(self, window, now):
+        if window >= DAY:
+            up, total = self.day_up, self.day_total
+        else:
+            since = int(now // 60) - window // 60
+            up = total = 0
+            for minute, bucket_up, bucket_total in reversed(self.buckets):
+                if minute <= since:
+                    break
+                up += bucket_up
+                total += bucket_total
+        if total > 0:
+            return round(min(100, 100 * up / total), 2)
+
+    def summary(self, now):
+        return dict(
+            availability_1h=self.availability(HOUR, now),
+            availability_24h=self.availability(DAY, now),
+            ratio=round(self.ratio, 2) if self.ratio is not None else None,
+            latency=round(self.latency * 1000, 1) if self.latency is not None else None,
+            failures=self.failures,
+            interval=round(self.interval, 1))
+
+
+class HealthProber:
+    """
+    Probes active services with status request on timer wheel.
+    Interval shrinks after failure and grows while service is stable
+    """
+
+    def __init__(self, manager, tick=PROBE_TICK, min_interval=PROBE_MIN_INTERVAL,
+                 max_interval=PROBE_MAX_INTERVAL, max_inflight=PROBE_MAX_INFLIGHT, **kwargs):
+        self.manager = manager
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.wheel = TimerWheel(tick, PROBE_WHEEL_SLOTS)
+        self.max_inflight = max_inflight
+        self.stats = dict()
+        self.inflight = set()
+
+    def sync(self):
+        """
+        Schedules newly active services, unschedules inactive ones.
+        Stats of services removed from catalogue are dropped
+        """
+        services = list(self.manager.values())
+        known = {svc.name for svc in services}
+        for name in [n for n in self.stats if n not in known and n not in self.inflight]:
+            self.wheel.cancel(name)
+            del self.stats[name]
+        for svc in services:
+            name = svc.name
+            # stale services are probed to confirm restored state
+            if not svc.is_active() and not svc.stale:
+                self.wheel.cancel(name)
+                continue
+            if name not in self.wheel and name not in self.inflight:
+                stats = self.stats.setdefault(name, ProbeStats(self.min_interval))
+                self.wheel.schedule(name, stats.interval)
+
+    async def run(self):
+        ticks = 0
+        sync_every = max(1, int(PROBE_SYNC_INTERVAL / self.wheel.tick))
+        while True:
+            try:
+                await asyncio.sleep(self.wheel.tick)
+                if ticks % sync_every == 0:
+                    self.sync()
+                ticks += 1
+                for name in self.wheel.advance():
+                    if len(self.inflight) >= self.max_inflight:
+                        # postpone to keep probe load flat
+                        self.wheel.schedule(name, self.wheel.tick)
+                        continue
+                    self.inflight.add(name)
+                    asyncio.ensure_future(self.probe(name))
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                logger.exception('health prober')
+
+    async def probe(self, name):
+        stats = self.stats.setdefault(name, ProbeStats(self.min_interval))
+        started = time()
+        try:
+            ok = await self.manager.request_app_state(name)
+        except Exception:
+            ok = False
+        finally:
+            self.inflight.discard(name)
+        now = time()
+        stats.record(ok, now - started, now)
+        if ok:
+            stats.streak += 1
+            stats.failures = 0
+            if stats.streak >= PROBE_STABLE_STREAK:
+                stats.interval = min(self.max_interval, stats.interval * 1.5)
+        else:
+            stats.streak = 0
+            stats.failures += 1
+            stats.interval = self.min_interval
+        svc = self.manager.state.get(name)
+        if svc:
+            svc.set_health(stats.summary(now))
+        self.wheel.schedule(name, stats.interval)
+
+    def report(self):
+        now = time()
+        return dict(
+            scheduled=len(self.wheel),
+            inflight=len(self.inflight),
+            services={name: s.summary(now) for name, s in self.stats.items()})
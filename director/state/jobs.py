@@ -0,0 +1,202 @@
+import asyncio
+import heapq
+from collections import deque
+from itertools import count
+from time import time
+
+from ..constants import (
+    JOB_QUEUED, JOB_WAITING, JOB_RUNNING, JOB_DONE, JOB_FAILED, JOB_CANCELLED,
+    JOB_MERGED, JOB_FINISHED, JOBS_HISTORY, PRIORITY_NORMAL)
+from ..flake import Flake
+
+idgen = Flake()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def silence(fut):
+    """
+    Results of fire-and-forget jobs are not awaited by anyone
+    """
+    if not fut.cancelled():
+        fut.exception()
+
+
+class Job:
+    """
+    Tracked lifecycle operation of service
+    """
+    __slots__ = (
+        'id', 'name', 'kind', 'kwargs', 'priority', 'state', 'error', 'merged_into',
+        'created', 'started', 'finished', 'phases', 'waiters', 'cancellable', 'task',
+        'result', '_notify')
+
+    def __init__(self, name, kind, kwargs, priority=PRIORITY_NORMAL, notify=None):
+        self.id = idgen.take()[1]
+        self.name = name
+        self.kind = kind
+        self.kwargs = kwargs
+        self.priority = priority
+        self.state = JOB_QUEUED
+        self.error = None
+        self.merged_into = None
+        self.created = time()
+        self.started = None
+        self.finished = None
+        self.phases = []
+        self.cancellable = False
+        self.task = None
+        self.result = None
+        self._notify = notify
+        fut = asyncio.get_event_loop().create_future()
+        fut.add_done_callback(silence)
+        self.waiters = [fut]
+
+    @property
+    def future(self):
+        return self.waiters[0]
+
+    @property
+    def done(self):
+        return self.state in JOB_FINISHED
+
+    @property
+    def wait_time(self):
+        return (self.started or time()) - self.created
+
+    def set_state(self, state, error=None):
+        self.state = state
+        if state == JOB_RUNNING:
+            self.started = time()
+        elif state in JOB_FINISHED:
+            self.finished = time()
+            self.cancellable = False
+        if error:
+            self.error = error
+        self.phase(state)
+
+    def phase(self, phase):
+        self.phases.append((phase, time()))
+        if self._notify:
+            self._notify(self)
+
+    def merge(self, other):
+        """
+        Take over waiters of redundant job
+        """
+        self.waiters.extend(other.waiters)
+        other.waiters = []
+        other.merged_into = self.id
+        other.set_state(JOB_MERGED)
+
+    def resolve(self, result=None, exc=None):
+        if not exc:
+            self.result = result
+        for fut in self.waiters:
+            if fut.done():
+                continue
+            if exc:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(result)
+
+    def as_dict(self):
+        duration = (self.finished or time()) - self.started if self.started else None
+        return dict(
+            id=self.id,
+            name=self.name,
+            kind=self.kind,
+            state=self.state,
+            priority=self.priority,
+            error=self.error,
+            merged_into=self.merged_into,
+            created=self.created,
+            started=self.started,
+            finished=self.finished,
+            wait_time=self.wait_time,
+            duration=duration,
+            result=self.result,
+            phases=[dict(phase=p, ts=ts) for p, ts in self.phases])
+
+
+class PriorityBudget:
+    """
+    Semaphore granting free slots to waiters with lowest priority value first
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._waiters = []
+        self._seq = count()
+
+    @property
+    def waiting(self):
+        return sum(1 for _, _, fut in self._waiters if not fut.done())
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            return
+        fut = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # slot was handed over right before cancellation
+            if not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                # handing slot over, active count unchanged
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+
+class JobRegistry:
+    """
+    Active jobs and bounded history of finished ones
+    """
+
+    def __init__(self, history=JOBS_HISTORY):
+        self.jobs = dict()
+        self.history = deque(maxlen=history)
+
+    def add(self, job):
+        self.jobs[job.id] = job
+        self.history.append(job)
+        # dropping finished jobs pushed out of history
+        if len(self.jobs) > self.history.maxlen:
+            kept = set(j.id for j in self.history)
+            for job_id in list(self.jobs):
+                if job_id not in kept and self.jobs[job_id].done:
+                    del self.jobs[job_id]
+
+    def get(self, job_id):
+        try:
+            return self.jobs.get(int(job_id))
+        except ValueError:
+            return None
+
+    def list(self, name=None, active=None):
+        return [j for j in self.jobs.values()
+                if (name is None or j.name == name) and (active is None or active != j.done)]
+
+    def stats(self, budget):
+        finished = [j for j in self.history if j.started and j.state in (JOB_DONE, JOB_FAILED)]
+        waits = [j.wait_time for j in finished]
+        return dict(
+            queued=sum(1 for j in self.jobs.values() if j.state == JOB_QUEUED),
+            waiting=sum(1 for j in self.jobs.values() if j.state == JOB_WAITING),
+            running=sum(1 for j in self.jobs.values() if j.state == JOB_RUNNING),
+            heavy_active=budget.active,
+            heavy_limit=budget.limit,
+            avg_wait=sum(waits) / len(waits) if waits else 0,
+            max_wait=max(waits) if waits else 0)
@@ -1,5 +1,8 @@
 import asyncio
 import ujson
+from hashlib import sha1
+from time import time
+from typing import NamedTuple, List
 from prodict import Prodict as pdict
 from itertools import count
 from copy import deepcopy
@@ -9,31 +12,69 @@ from band.constants import (
     NOTIFY_ALIVE, REQUEST_STATUS, OK, FRONTIER_SERVICE,
     DIRECTOR_SERVICE)
 
-from ..helpers import nn, merge_dicts
+from ..helpers import nn, merge_dicts, stable_hash, BOOT_ID
 from ..band_config import BandConfig
 from ..constants import (
     STARTED_SET, SERVICE_TIMEOUT, DEFAULT_COL, DEFAULT_ROW,
     STATUS_RESTARTING, STATUS_REMOVING, STATUS_STARTING,
-    STATUS_STOPPING, SHARED_CONFIG_KEY)
+    STATUS_STOPPING, SHARED_CONFIG_KEY, SNAPSHOT_INTERVAL, LIST_CACHE_TTL,
+    OP_RUN, OP_START, OP_STOP, OP_RESTART, OP_REMOVE, OP_PREBUILD, OP_ROLLING_APPLY,
+    ROLLING_APPLY_KEY, PRIORITY_NORMAL, PRIORITY_LOW, IMAGES_KEEP, IMAGES_GC_INTERVAL)
 
 from ..docker_manager import DockerManager
+from ..band_container import replicas_state
+from ..tracing import tracer
+from .. import metrics
 from .context import StateCtx
 from .service import ServiceState
 from ..image_navigator import ImageNavigator
 from .grid import is_valid_pos, ServicesGrid
+from .reconciler import Reconciler
+from .snapshot import snapshot_store
+from .bus import StateBus
+from .operations import OperationQueue
+from .prebuild import Prebuilder
+from .health import HealthProber
+
+RPC_STATUS = metrics.rpc_request.labels(REQUEST_STATUS)
+RPC_STATUS_TIMEOUTS = metrics.rpc_timeouts.labels(REQUEST_STATUS)
 
 image_navigator = ImageNavigator(**settings)
 band_config = BandConfig(**settings)
 dock = DockerManager(image_navigator=image_navigator, **settings)
 
 
+class ListSnapshot(NamedTuple):
+    version: int
+    etag: str
+    items: List
+    body: bytes
+    valid_until: float
+
+
 class StateManager:
     def __init__(self):
         self.timeout = 30
         self._state = dict()
+        self._version = 0
+        self._list_snapshot = None
+        self.bus = StateBus(self)
         self._shared_config = dict()
         self.registrations_hash = ''
         self.grid = ServicesGrid(self)
+        self.reconciler = Reconciler(self, dock, image_navigator)
+        self.snapshots = snapshot_store(band_config, **settings)
+        self.health = HealthProber(self, **(settings.get('health_probe') or {}))
+        self.prebuilder = Prebuilder(self, dock, image_navigator, **(settings.get('prebuild') or {}))
+        self.ops = OperationQueue({
+            OP_RUN: self._do_run_service,
+            OP_START: self._do_start_service,
+            OP_STOP: self._do_stop_service,
+            OP_RESTART: self._do_restart_service,
+            OP_REMOVE: self._do_remove_service,
+            OP_PREBUILD: self.prebuilder.build,
+            OP_ROLLING_APPLY: self._do_rolling_apply},
+            notify=self.bus.job_changed)
 
     """
     Lifecycle functions
@@ -41,27 +82,38 @@ class StateManager:
 
     async def initialize(self):
         await band_config.initialize()
+        await self.restore_snapshot()
         await image_navigator.load()
+        await self.index_images()
+        await band_config.migrate_index()
         await self.load_config(SHARED_CONFIG_KEY)
-        await self.resolve_docstatus_all()
-        await dock.initialize()
 
         # initial fill autostart 
         started_present = await band_config.set_exists(STARTED_SET)
         if not started_present:
             await band_config.set_add(STARTED_SET, *settings.initial_startup)
 
-        # looking for containers to request status
-        for container in await dock.containers():
-            if container.running and container.native:
+        await self.preload(await self.should_start())
+        await self.resolve_docstatus_all()
+        await dock.initialize()
+
+        # looking for services to request status
+        for name, containers in (await dock.services_containers()).items():
+            if any(c.running and c.native for c in containers):
                 await scheduler.spawn(
-                    self.request_app_state(container.name))
+                    self.request_app_state(name))
         
         # spawning state cleaner job
         await scheduler.spawn(self.clean_worker())
 
         await scheduler.spawn(self.images_loader())
 
+        await scheduler.spawn(self.snapshot_worker())
+
+        await scheduler.spawn(self.images_gc())
+
+        await scheduler.spawn(self.health.run())
+
         # handling autostart
         await self.handle_auto_start()
 
@@ -70,16 +122,53 @@ class StateManager:
             await asyncio.sleep(15)
             try:
                 await image_navigator.load()
+                await self.index_images()
+                await self.prebuilder.check()
             except Exception:
                 logger.exception('ex')
 
+    async def images_gc(self):
+        params = settings.get('image_retention') or {}
+        while True:
+            await asyncio.sleep(params.get('interval', IMAGES_GC_INTERVAL))
+            try:
+                await self.prune_images()
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                logger.exception('images gc')
+
+    async def prune_images(self):
+        """
+        Applies images retention policy. Each image removed under single heavy slot
+        with low priority, deploys are not blocked for whole prune
+        """
+        params = settings.get('image_retention') or {}
+        return await dock.prune_images(
+            keep=params.get('keep', IMAGES_KEEP),
+            slot=lambda: self.ops.heavy_slot(PRIORITY_LOW))
+
+    async def index_images(self):
+        """
+        Updates images meta and pushes changes to loaded services
+        """
+        changed = await image_navigator.index_meta(await dock.images_labels())
+        for name in changed:
+            svc = self._state.get(name)
+            if svc and svc.loaded:
+                svc.set_meta(await image_navigator.image_meta(name))
+                svc.apply_meta()
+        if changed:
+            logger.debug('images meta updated', names=changed)
+
     async def clean_worker(self):
         while True:
             # Remove expired services
             try:
                 await asyncio.sleep(5)
-                await self.resolve_docstatus_all()
-                await self.check_regs_changed()
+                with metrics.clean_cycle.time():
+                    await self.resolve_docstatus_all()
+                    await self.check_regs_changed()
             except ConnectionRefusedError:
                 logger.error('Redis connection refused')
             except asyncio.CancelledError:
@@ -90,16 +179,26 @@ class StateManager:
             await asyncio.sleep(1)
 
     async def handle_auto_start(self):
-        services = await self.should_start()
-        logger.info("Autostarting services", items=services)
-        for item in services:
-            svc = await self.get(item)
-            if not svc.is_active() and image_navigator.is_native(svc.name):
-                await self.run_service(svc.name)
-            # if not (item in state and ().is_active()):
-            # asyncio.ensure_future(run(item))
+        """
+        Bring autostart services to desired state acting only on drift
+        """
+        await self.reconciler.reconcile()
+
+    async def snapshot_worker(self):
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            try:
+                await self.save_snapshot()
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                logger.exception('state snapshot')
 
     async def unload(self):
+        try:
+            await self.save_snapshot()
+        except Exception:
+            logger.exception('state snapshot')
         await band_config.unload()
         await dock.close()
 
@@ -123,6 +222,56 @@ class StateManager:
     def is_exists(self, name):
         return name in self._state
 
+    @property
+    def version(self):
+        return self._version
+
+    def touch(self, svc):
+        """
+        Bump state version on any service mutation
+        """
+        self._version += 1
+        svc.set_version(self._version)
+        self.bus.mark(svc)
+
+    def list_snapshot(self):
+        """
+        Serialized list of visible services memoized by state version.
+        Rebuilt when version changes or some service state expires
+        """
+        now = time()
+        snapshot = self._list_snapshot
+        if snapshot and snapshot.version == self._version and now < snapshot.valid_until:
+            return snapshot
+        items = []
+        valid_until = now + LIST_CACHE_TTL
+        for svc in self._state.values():
+            if svc.is_active() or svc.is_local():
+                items.append(svc.full_state())
+            expires = svc.expires_at()
+            if expires and expires > now:
+                valid_until = min(valid_until, expires)
+        body = ujson.dumps(items, ensure_ascii=False).encode()
+        etag = '"{}"'.format(sha1(body).hexdigest()[:20])
+        # reading version after build, expiration may bump it
+        self._list_snapshot = ListSnapshot(self._version, etag, items, body, valid_until)
+        return self._list_snapshot
+
+    def list_diff(self, since_version, epoch=None):
+        """
+        Services changed after specified version and names of all visible services.
+        Version of other process or from future gets full list
+        """
+        snapshot = self.list_snapshot()
+        full = (epoch is not None and epoch != BOOT_ID) or since_version > snapshot.version
+        return dict(
+            version=snapshot.version,
+            epoch=BOOT_ID,
+            full=full,
+            changed=[item for item in snapshot.items
+                     if full or self._state[item.name].version > since_version],
+            present=[item.name for item in snapshot.items])
+
     """
     Container management functions
     """
@@ -131,41 +280,51 @@ class StateManager:
         params = kwargs.pop('params', pdict())
         positions = []
         
-        # Container env
+        # Container env: meta defaults, saved config, passed params
         envs = []
-        if params.env:
-            envs.append(params.env)
 
         if params.get('pos') and is_valid_pos(params.pos):
             positions.append(params.pos)
 
-        if name not in self._state:
+        svc = self._state.get(name)
+        # state restored from snapshot also should load config
+        if not svc or not svc.loaded:
             logger.debug('loading state', name=name)
-            config = await self.load_config(name)
+            # config could be passed when loaded in bulk
+            if 'config' in kwargs:
+                config = kwargs['config']
+            else:
+                config = await self.load_config(name)
             meta = await image_navigator.image_meta(name)
-            svc = ServiceState(name=name, manager=self)
+            svc = svc or ServiceState(name=name, manager=self)
+            svc.set_loaded()
+
+            if meta:
+                svc.set_meta(meta)
+                if meta.env:
+                    envs.append(meta.env)
 
             if config:
+                svc.set_config_extra(config)
                 if config.get('env'):
                     envs.append(config['env'])
                 if config.get('pos') and is_valid_pos(config['pos']):
                     positions.append(config['pos'])
 
-            if meta:
-                svc.set_meta(meta)
-                if meta.env:
-                    envs.append(meta.env)
-                if meta.get('pos') and is_valid_pos(meta['pos']):
-                    positions.append(meta['pos'])
+            if meta and meta.get('pos') and is_valid_pos(meta['pos']):
+                positions.append(meta['pos'])
 
             positions.append(self.grid.default_pos)
             self._state[name] = svc
 
         svc = self._state[name]
 
+        if params.env:
+            envs.append(params.env)
+
         # env variables
         if len(envs):
-            svc.set_env(merge_dicts(*envs))
+            svc.set_env(merge_dicts(pdict(), *envs))
 
         # passed build options
         if params.build_opts:
@@ -180,34 +339,74 @@ class StateManager:
 
         return svc
 
+    async def preload(self, names):
+        """
+        Load states of services not loaded yet, configs fetched by single request
+        """
+        names = [n for n in set(names) if n not in self._state or not self._state[n].loaded]
+        if not names:
+            return
+        configs = await band_config.load_configs(names)
+        for name in names:
+            await self.get(name, config=configs.get(name))
+
     def logs_reader(self):
         return dock.get_log_reader()
 
-    async def run_service(self, name, no_wait=False):
+    def state_reader(self, since=None, epoch=None):
+        return self.bus.subscribe(since, epoch)
+
+    def service_env(self, svc):
+        """
+        Service env merged over shared env
+        """
+        env = deepcopy(self._shared_config.get('env', {}))
+        env.update(svc.env)
+        return env
+
+    async def submit(self, name, kind, no_wait=False, priority=PRIORITY_NORMAL, **kwargs):
+        """
+        Queue service operation as tracked job. Waits for completion unless no_wait passed
+        """
+        job = await self.ops.submit(name, kind, priority=priority, **kwargs)
+        if not no_wait:
+            await job.future
+        return job
+
+    async def run_service(self, name, no_wait=False, build=True, priority=PRIORITY_NORMAL):
         svc = await self.get(name)
         svc.clean_status()
         svc.set_status_override(STATUS_STARTING)
-        coro = self._do_run_service(name)
-        await (scheduler.spawn(coro) if no_wait else coro)
-        return svc
+        return await self.submit(name, OP_RUN, no_wait=no_wait, priority=priority, build=build)
 
-    async def _do_run_service(self, name):
-        svc = await self.get(name)
-        env = deepcopy(self._shared_config.get('env', {}))
-        env.update(svc.env)
-        await dock.run_container(name, env=env, **svc.build_options)
-        await band_config.set_add(STARTED_SET, name)
-        logger.debug('service. saving config', svc=dict(bo=svc.build_options, e=svc.env))
-        svc.save_config()
-        await self.resolve_docstatus(name)
+    async def _do_run_service(self, name, build=True):
+        with tracer.span(name, 'total'):
+            svc = await self.get(name)
+            env = self.service_env(svc)
+            if build:
+                fingerprint = await self.prebuilder.fingerprint(name)
+                if svc.build_options.get('nocache') or not await self.prebuilder.fresh(name, fingerprint):
+                    # build could be superseded by next run or remove request
+                    with self.ops.cancellable(name):
+                        self.ops.phase(name, 'build')
+                        await dock.build_image(name, **svc.build_options)
+                    await self.prebuilder.built(name, fingerprint)
+                else:
+                    logger.info('using prebuilt image', name=name)
+            self.ops.phase(name, 'create')
+            await dock.run_container(name, env=env, build=False, **svc.build_options)
+            # closed when service reports its state first time
+            tracer.begin(name, 'alive')
+            await band_config.set_add(STARTED_SET, name)
+            logger.debug('service. saving config', svc=dict(bo=svc.build_options, e=svc.env))
+            svc.save_config()
+            await self.resolve_docstatus(name)
 
     async def remove_service(self, name, no_wait=False):
         svc = await self.get(name)
         await band_config.set_rm(STARTED_SET, name)
         svc.set_status_override(STATUS_REMOVING)
-        coro = self._do_remove_service(name)
-        await (scheduler.spawn(coro) if no_wait else coro)
-        return svc
+        return await self.submit(name, OP_REMOVE, no_wait=no_wait)
 
     async def _do_remove_service(self, name):
         svc = await self.get(name)
@@ -218,9 +417,7 @@ class StateManager:
         svc = await self.get(name)
         await band_config.set_rm(STARTED_SET, name)
         svc.set_status_override(STATUS_STOPPING)
-        coro = self._do_stop_service(name)
-        await (scheduler.spawn(coro) if no_wait else coro)
-        return svc
+        return await self.submit(name, OP_STOP, no_wait=no_wait)
 
     async def _do_stop_service(self, name):
         svc = await self.get(name)
@@ -232,9 +429,7 @@ class StateManager:
         if svc.native:
             await band_config.set_add(STARTED_SET, name)
         svc.set_status_override(STATUS_STARTING)
-        coro = self._do_start_service(name)
-        await (scheduler.spawn(coro) if no_wait else coro)
-        return svc
+        return await self.submit(name, OP_START, no_wait=no_wait)
 
     async def _do_start_service(self, name):
         svc = await self.get(name)
@@ -244,18 +439,33 @@ class StateManager:
     async def restart_service(self, name, no_wait=False):
         svc = await self.get(name)
         svc.set_status_override(STATUS_RESTARTING)
-        coro = self._do_restart_service(name)
-        await (scheduler.spawn(coro) if no_wait else coro)
-        return svc
+        return await self.submit(name, OP_RESTART, no_wait=no_wait)
 
     async def _do_restart_service(self, name):
-        container = await dock.get(name)
-        svc = await self.get(name)
-        if container:
-            svc.clean_status()
-            await dock.restart_container(name)
-            svc.clean_status()
-            await self.check_regs_changed()
+        with tracer.span(name, 'restart'):
+            containers = await dock.service_containers(name)
+            svc = await self.get(name)
+            if containers:
+                svc.clean_status()
+                await dock.restart_container(name)
+                # closed when service reports its state after restart
+                tracer.begin(name, 'alive')
+                svc.clean_status()
+                await self.check_regs_changed()
+
+    async def rolling_apply(self, batch, health_timeout):
+        """
+        Queues rolling apply as tracked job. Returns already active one instead of second run
+        """
+        job = self.ops.active(ROLLING_APPLY_KEY)
+        if job:
+            return job
+        return await self.submit(
+            ROLLING_APPLY_KEY, OP_ROLLING_APPLY, no_wait=True,
+            batch=batch, health_timeout=health_timeout)
+
+    async def _do_rolling_apply(self, name, batch, health_timeout):
+        return await self.reconciler.rolling_apply(batch=batch, health_timeout=health_timeout)
 
     async def set_pos(self, name, pos, svc=None):
         """
@@ -275,15 +485,23 @@ class StateManager:
     State functions
     """
 
-    async def resolve_docstatus(self, name):
+    async def resolve_docstatus(self, name, containers=None):
+        """
+        Updates service docker state aggregated over its replicas
+        """
         svc = await self.get(name)
-        container = await dock.get(name)
-        if container:
-            svc.set_dockstate(container.full_state())
+        if containers is None:
+            containers = await dock.service_containers(name)
+        for container in containers:
+            await container.fill()
+        if containers:
+            svc.set_dockstate(replicas_state(containers))
 
     async def resolve_docstatus_all(self):
-        for container in await dock.containers():
-            await self.resolve_docstatus(container.name)
+        groups = await dock.services_containers()
+        await self.preload(groups)
+        for name, containers in groups.items():
+            await self.resolve_docstatus(name, containers)
 
     async def clean_status(self, name):
         (await self.get(name)).clean_status()
@@ -298,12 +516,17 @@ class StateManager:
             payload.update(dict(state_hash=self.registrations_hash))
 
         # Loading state, config, meta
-        status = await rpc.request(name, REQUEST_STATUS, **payload)
+        with RPC_STATUS.time():
+            status = await rpc.request(name, REQUEST_STATUS, **payload)
+        if status is None:
+            RPC_STATUS_TIMEOUTS.inc()
         if status:
+            tracer.finish(name, 'alive')
             svc.set_appstate(dict(status))
+        return bool(status)
 
     async def check_regs_changed(self):
-        new_hash = hash(str(self.registrations()))
+        new_hash = stable_hash(self.registrations())
         # If registrations changed front shold know about that
         if new_hash != self.registrations_hash:
             self.registrations_hash = new_hash
@@ -317,6 +540,34 @@ class StateManager:
                     methods.append(method)
         return dict(register=methods)
 
+    def snapshot(self):
+        return dict(
+            registrations_hash=self.registrations_hash,
+            services={name: svc.snapshot() for name, svc in self._state.items()})
+
+    async def save_snapshot(self):
+        await self.snapshots.save(self.snapshot())
+
+    async def restore_snapshot(self):
+        """
+        Restore services state saved before restart. Data marked as stale
+        until fresh docker and app states arrive
+        """
+        try:
+            snapshot = await self.snapshots.load()
+        except Exception:
+            logger.exception('state snapshot restore')
+            return
+        if not snapshot:
+            return
+        for name, svc_snapshot in (snapshot.get('services') or {}).items():
+            if name not in self._state:
+                svc = ServiceState(name=name, manager=self)
+                svc.restore(svc_snapshot)
+                self._state[name] = svc
+        self.registrations_hash = snapshot.get('registrations_hash') or ''
+        logger.info('state restored from snapshot', services=len(self._state))
+
     def clean_ctx(self, name, coro):
         return StateCtx(self, name, coro)
 
@@ -336,27 +587,24 @@ class StateManager:
 
     def save_config(self, name, config):
         logger.info('saving', name=name, config=config)
-        job = scheduler.spawn(band_config.save_config(name, config))
-        asyncio.ensure_future(job)
+        band_config.save_config(name, config)
 
     async def runned_set(self):
         return await band_config.set_get(STARTED_SET)
 
     async def update_config(self, name, keysvals):
-        config = (await self.load_config(name)) or pdict()
-        for k, v in keysvals.items():
-            target = config
-            path = k.split('.')
-            prop = path.pop()
-            for p in path:
-                target = target[p]
-            if v == '':
-                target.pop(prop, None)
-            else:
-                target[prop] = v
-        self.save_config(name, config)
+        config = await band_config.update_config(name, keysvals)
         if name == SHARED_CONFIG_KEY:
             self._shared_config = config
+        svc = self._state.get(name)
+        if svc and svc.loaded:
+            # next save_config writes whole config from state, should not revert update
+            svc.replace_build_opts(**(config.get('build_options') or {}))
+            envs = [e for e in ((svc.meta or {}).get('env'), config.get('env')) if e]
+            svc.set_env(merge_dicts(pdict(), *envs))
+            if config.get('pos') and is_valid_pos(config['pos']):
+                await self.set_pos(name, config['pos'], svc=svc)
+            svc.set_config_extra(config)
         return config
 
     async def should_start(self):
@@ -0,0 +1,215 @@
+import asyncio
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from band import logger, scheduler
+
+from ..constants import (
+    OP_RUN, OP_START, OP_STOP, OP_RESTART, OP_REMOVE, OP_PREBUILD, HEAVY_OPS, HEAVY_OPS_LIMIT,
+    JOB_QUEUED, JOB_WAITING, JOB_RUNNING, JOB_DONE, JOB_FAILED, JOB_CANCELLED,
+    PRIORITY_NORMAL)
+from .jobs import Job, JobRegistry, JobCancelled, PriorityBudget
+
+
+class ServiceOperations:
+    """
+    Serialized operations of single service
+    """
+    __slots__ = ('name', 'pending', 'current', 'worker')
+
+    def __init__(self, name):
+        self.name = name
+        self.pending = deque()
+        self.current = None
+        self.worker = None
+
+    def supersede_pending(self, job, kinds):
+        keep = deque()
+        for pending in self.pending:
+            if pending.kind in kinds:
+                job.merge(pending)
+            else:
+                keep.append(pending)
+        self.pending = keep
+
+    def cancel_current(self, job, kinds):
+        current = self.current
+        if current and current.cancellable and current.kind in kinds and current.task:
+            logger.info('cancelling superseded operation', name=self.name, kind=current.kind)
+            job.merge(current)
+            current.task.cancel()
+
+    def enqueue(self, job):
+        """
+        Add job coalescing it with redundant pending ones
+        """
+        last = self.pending[-1] if self.pending else None
+        if job.kind == OP_REMOVE:
+            self.supersede_pending(
+                job, (OP_RUN, OP_START, OP_STOP, OP_RESTART, OP_REMOVE, OP_PREBUILD))
+            self.cancel_current(job, (OP_RUN, OP_PREBUILD))
+        elif job.kind == OP_RUN:
+            # container recreation covers start, restart and build.
+            # running prebuild is kept, run will use its result
+            self.supersede_pending(job, (OP_RUN, OP_START, OP_RESTART, OP_PREBUILD))
+            self.cancel_current(job, (OP_RUN,))
+        elif last and last.kind == job.kind and last.kwargs == job.kwargs:
+            last.merge(job)
+            return
+        elif last and last.kind == OP_STOP and job.kind == OP_START:
+            last.kind = OP_RESTART
+            last.merge(job)
+            return
+        elif last and last.kind == OP_RUN and job.kind in (OP_START, OP_RESTART, OP_PREBUILD):
+            last.merge(job)
+            return
+        self.pending.append(job)
+
+    def remove(self, job):
+        self.pending = deque(j for j in self.pending if j is not job)
+
+
+class OperationQueue:
+    """
+    Per-service lifecycle operations queue.
+    Serializes operations of each service, coalesces redundant requests
+    and limits number of heavy operations running on host at once.
+    Each request is tracked as job
+    """
+
+    def __init__(self, handlers, heavy_limit=HEAVY_OPS_LIMIT, notify=None):
+        self.handlers = handlers
+        self.heavy = PriorityBudget(heavy_limit)
+        self.jobs = JobRegistry()
+        self.notify = notify
+        self.services = dict()
+
+    async def submit(self, name, kind, priority=PRIORITY_NORMAL, **kwargs):
+        """
+        Returns job. Its future resolved when job (or one it was merged with) completes
+        """
+        job = Job(name, kind, kwargs, priority=priority, notify=self.notify)
+        self.jobs.add(job)
+        job.set_state(JOB_QUEUED)
+        ops = self.services.get(name)
+        if not ops:
+            ops = self.services[name] = ServiceOperations(name)
+        ops.enqueue(job)
+        if not ops.worker:
+            ops.worker = await scheduler.spawn(self.worker(ops))
+        return job
+
+    def cancel(self, job_id):
+        """
+        Cancel queued job or running one at cancellable stage.
+        Returns False if job can't be cancelled
+        """
+        job = self.jobs.get(job_id)
+        if not job or job.done:
+            return False
+        ops = self.services[job.name]
+        if job.state == JOB_QUEUED and job in ops.pending:
+            ops.remove(job)
+            job.set_state(JOB_CANCELLED)
+            job.resolve(exc=JobCancelled())
+            return True
+        if job.cancellable and job.task:
+            job.set_state(JOB_CANCELLED)
+            job.task.cancel()
+            return True
+        return False
+
+    @contextmanager
+    def cancellable(self, name):
+        """
+        Marks code block of current job as safe to cancel
+        """
+        ops = self.services.get(name)
+        job = ops and ops.current
+        if job:
+            job.cancellable = True
+        try:
+            yield
+        finally:
+            if job:
+                job.cancellable = False
+
+    @asynccontextmanager
+    async def heavy_slot(self, priority=PRIORITY_NORMAL):
+        """
+        Holds heavy operations slot for work done outside of jobs
+        """
+        await self.heavy.acquire(priority)
+        try:
+            yield
+        finally:
+            self.heavy.release()
+
+    def phase(self, name, phase):
+        """
+        Record phase of current job
+        """
+        ops = self.services.get(name)
+        if ops and ops.current:
+            ops.current.phase(phase)
+
+    async def execute(self, name, job):
+        handler = self.handlers[job.kind]
+        if job.kind not in HEAVY_OPS:
+            job.set_state(JOB_RUNNING)
+            return await handler(name, **job.kwargs)
+        # waiting for budget is safe to cancel
+        job.cancellable = True
+        job.set_state(JOB_WAITING)
+        await self.heavy.acquire(job.priority)
+        try:
+            job.cancellable = False
+            job.set_state(JOB_RUNNING)
+            return await handler(name, **job.kwargs)
+        finally:
+            self.heavy.release()
+
+    async def worker(self, ops):
+        try:
+            while ops.pending:
+                job = ops.current = ops.pending.popleft()
+                job.task = asyncio.ensure_future(self.execute(ops.name, job))
+                try:
+                    result = await job.task
+                    job.set_state(JOB_DONE)
+                    job.resolve(result)
+                except asyncio.CancelledError:
+                    if job.done:
+                        # superseded or cancelled by request
+                        job.resolve(exc=JobCancelled())
+                        continue
+                    job.task.cancel()
+                    raise
+                except Exception as exc:
+                    logger.exception('operation failed', name=ops.name, kind=job.kind)
+                    job.set_state(JOB_FAILED, error=repr(exc))
+                    job.resolve(exc=exc)
+                finally:
+                    ops.current = None
+        finally:
+            ops.worker = None
+
+    def busy(self):
+        """
+        Any operation running or queued
+        """
+        return any(ops.current or ops.pending for ops in self.services.values())
+
+    def pending(self, name):
+        ops = self.services.get(name)
+        return len(ops.pending) if ops else 0
+
+    def active(self, name):
+        """
+        Running or last queued job of service
+        """
+        ops = self.services.get(name)
+        if ops:
+            return ops.current or (ops.pending[-1] if ops.pending else None)
+
+    def stats(self):
+        return self.jobs.stats(self.heavy)
@@ -0,0 +1,113 @@
+import asyncio
+from time import time
+from prodict import Prodict as pdict
+from band import logger, scheduler
+
+from ..constants import (
+    OP_PREBUILD, PRIORITY_LOW, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED,
+    JOB_CANCELLED, JOB_MERGED)
+
+ACTIVE = (JOB_QUEUED, JOB_RUNNING)
+
+
+class Prebuilder:
+    """
+    Builds images in background when their sources change,
+    so following run only creates and starts container
+    """
+
+    def __init__(self, manager, dock, image_navigator, enabled=False, concurrency=1):
+        self.manager = manager
+        self.dock = dock
+        self.image_navigator = image_navigator
+        self.enabled = enabled
+        self.concurrency = concurrency
+        self._slots = None
+        # latest observed source fingerprints, by service key like runs and jobs
+        self._fingerprints = {}
+        self._status = {}
+
+    def status(self, name):
+        return self._status.get(name)
+
+    async def check(self):
+        """
+        Schedules prebuild of images with changed sources
+        """
+        if not self.enabled:
+            return
+        prints = await self.image_navigator.fingerprints()
+        previous, self._fingerprints = self._fingerprints, prints
+        if not previous:
+            # first scan is baseline
+            return
+        for name, fingerprint in prints.items():
+            status = self._status.get(name)
+            if status and status.state in ACTIVE:
+                continue
+            # attempted fingerprint is kept by any outcome, failed
+            # build is retried only when sources change again
+            if previous.get(name) != fingerprint or (status and status.fingerprint != fingerprint):
+                self._status[name] = pdict(state=JOB_QUEUED, fingerprint=fingerprint, ts=time())
+                await scheduler.spawn(self.prebuild(name))
+
+    async def prebuild(self, name):
+        if not self._slots:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        async with self._slots:
+            job = await self.manager.submit(
+                name, OP_PREBUILD, no_wait=True, priority=PRIORITY_LOW)
+            self._status[name].job = job.id
+            try:
+                await job.future
+            except Exception:
+                pass
+            status = self._status[name]
+            if status.state == JOB_QUEUED:
+                # superseded by run or remove
+                status.update(state=JOB_MERGED, ts=time())
+
+    async def build(self, name):
+        """
+        Prebuild job handler
+        """
+        fingerprint = await self.image_navigator.fingerprint(name)
+        status = self._status.setdefault(name, pdict())
+        status.update(state=JOB_RUNNING, ts=time(), error=None)
+        try:
+            with self.manager.ops.cancellable(name):
+                self.manager.ops.phase(name, 'build')
+                await self.dock.build_image(name)
+        except asyncio.CancelledError:
+            status.update(state=JOB_CANCELLED, fingerprint=fingerprint, ts=time())
+            raise
+        except Exception as exc:
+            status.update(state=JOB_FAILED, fingerprint=fingerprint, ts=time(), error=repr(exc))
+            raise
+        await self.built(name, fingerprint)
+        logger.info('image prebuilt', name=name)
+
+    async def fingerprint(self, name):
+        if self.enabled:
+            return await self.image_navigator.fingerprint(name)
+
+    async def built(self, name, fingerprint):
+        """
+        Records image built from sources with given fingerprint
+        """
+        if not fingerprint:
+            return
+        self._status[name] = pdict(
+            state=JOB_DONE, fingerprint=fingerprint, ts=time(),
+            image_id=await self.dock.image_id(name))
+
+    async def fresh(self, name, fingerprint):
+        """
+        Built image exists and sources not changed since
+        """
+        status = self._status.get(name)
+        if not fingerprint or not status or status.state != JOB_DONE:
+            return False
+        if status.fingerprint != fingerprint:
+            return False
+        return status.image_id == await self.dock.image_id(name)
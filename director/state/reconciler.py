@@ -0,0 +1,171 @@
+import asyncio
+from time import time
+from typing import NamedTuple
+from prodict import Prodict as pdict
+from band import logger
+from band.constants import DIRECTOR_SERVICE
+
+from ..constants import (
+    ACTION_NONE, ACTION_START, ACTION_RECREATE, ACTION_REBUILD,
+    RECONCILE_CONCURRENCY, ROLLING_BATCH, ROLLING_HEALTH_TIMEOUT, HEALTH_POLL_INTERVAL)
+
+
+class ReconcileAction(NamedTuple):
+    name: str
+    action: str
+    reason: str
+
+
+class Reconciler:
+    """
+    Compares desired services state (started set, saved configs, image and env hash)
+    with actual containers and applies only the actions needed to remove drift
+    """
+
+    def __init__(self, manager, dock, image_navigator, concurrency=RECONCILE_CONCURRENCY):
+        self.manager = manager
+        self.dock = dock
+        self.image_navigator = image_navigator
+        self.concurrency = concurrency
+
+    async def diff(self, name, containers):
+        """
+        Detect minimal action for single service
+        """
+        if not self.image_navigator.is_native(name):
+            return ReconcileAction(name, ACTION_NONE, 'not native')
+        svc = await self.manager.get(name)
+        replicas = containers.get(name)
+        image_id = await self.dock.image_id(name)
+        if not image_id:
+            return ReconcileAction(name, ACTION_REBUILD, 'image missing')
+        if not replicas:
+            if svc.is_active():
+                return ReconcileAction(name, ACTION_NONE, 'active remotely')
+            return ReconcileAction(name, ACTION_RECREATE, 'container missing')
+        if len(replicas) != max(svc.build_options.get('replicas') or 1, 1):
+            return ReconcileAction(name, ACTION_RECREATE, 'replicas count')
+        env = self.manager.service_env(svc)
+        for container in replicas:
+            # containers created before hashing was introduced are trusted
+            actual_hash = container.config_hash
+            if actual_hash and actual_hash != self.dock.config_hash(image_id, env):
+                return ReconcileAction(name, ACTION_RECREATE, 'config drift')
+        if not all(c.running for c in replicas):
+            return ReconcileAction(name, ACTION_START, 'stopped')
+        return ReconcileAction(name, ACTION_NONE, 'in sync')
+
+    async def plan(self):
+        """
+        Build action plan without touching anything
+        """
+        desired = await self.manager.should_start()
+        await self.manager.preload(desired)
+        containers = await self.dock.services_containers()
+        return [await self.diff(name, containers) for name in sorted(desired)]
+
+    async def execute(self, action):
+        if action.action == ACTION_REBUILD:
+            await self.manager.run_service(action.name)
+        elif action.action == ACTION_RECREATE:
+            await self.manager.run_service(action.name, build=False)
+        elif action.action == ACTION_START:
+            await self.manager.start_service(action.name)
+
+    async def apply(self, plan):
+        """
+        Execute plan with bounded parallelism
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def runner(action):
+            async with semaphore:
+                try:
+                    await self.execute(action)
+                except Exception:
+                    logger.exception('reconcile action failed', action=action._asdict())
+
+        await asyncio.gather(*[runner(a) for a in plan if a.action != ACTION_NONE])
+        return plan
+
+    async def reconcile(self):
+        plan = await self.plan()
+        logger.info('Reconcile plan', plan=[a._asdict() for a in plan])
+        return await self.apply(plan)
+
+    """
+    Rolling apply
+    """
+
+    async def env_drifted(self):
+        """
+        Running services which effective env differs from one container created with
+        """
+        groups = await self.dock.services_containers()
+        await self.manager.preload(groups)
+        names = []
+        for name, containers in sorted(groups.items()):
+            if name == DIRECTOR_SERVICE or not self.image_navigator.is_native(name):
+                continue
+            svc = await self.manager.get(name)
+            env = self.manager.service_env(svc)
+            for container in containers:
+                if not container.running:
+                    continue
+                if container.config_hash:
+                    # container own image id, so only env change counts
+                    drifted = container.config_hash != self.dock.config_hash(container.image_id, env)
+                else:
+                    drifted = await self.env_differs(container, env)
+                if drifted:
+                    names.append(name)
+                    break
+        return names
+
+    async def env_differs(self, container, env):
+        """
+        Drift of container created without config hash label.
+        Image defaults are mixed into container env, so only expected
+        variables are compared and removed ones stay unnoticed
+        """
+        if not container.raw.get('Config'):
+            await container.fill()
+        actual = container.env
+        expected = self.dock.container_env(env)
+        return any(actual.get(str(k)) != str(v) for k, v in expected.items())
+
+    async def wait_healthy(self, name, timeout):
+        deadline = time() + timeout
+        while time() < deadline:
+            if await self.manager.request_app_state(name):
+                return True
+            await asyncio.sleep(HEALTH_POLL_INTERVAL)
+        return False
+
+    async def recreate(self, name, timeout):
+        try:
+            await self.manager.run_service(name, build=False)
+        except Exception:
+            logger.exception('rolling apply recreate failed', name=name)
+            return False
+        return await self.wait_healthy(name, timeout)
+
+    async def rolling_apply(self, batch=ROLLING_BATCH, health_timeout=ROLLING_HEALTH_TIMEOUT):
+        """
+        Recreates services with changed env in batches.
+        Next batch starts only when all services of previous one answer status request
+        """
+        batch = max(1, batch)
+        names = await self.env_drifted()
+        report = pdict(services=names, batches=[], failed=[])
+        logger.info('rolling apply', services=names, batch=batch)
+        for i in range(0, len(names), batch):
+            chunk = names[i:i + batch]
+            healthy = await asyncio.gather(*[self.recreate(n, health_timeout) for n in chunk])
+            report.batches.append(dict(zip(chunk, healthy)))
+            report.failed = [n for n, ok in zip(chunk, healthy) if not ok]
+            if report.failed:
+                logger.warn('rolling apply stopped', failed=report.failed,
+                            left=names[i + batch:])
+                break
+        return report
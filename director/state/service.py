@@ -2,12 +2,35 @@ from prodict import Prodict as pdict
 from typing import List, Dict
 from time import time
 from random import randint
-from collections import deque
 from ..constants import SERVICE_TIMEOUT, STATUS_RUNNING, STATUS_STARTING, STATUS_REMOVING
 from ..helpers import nn, isn, req_to_bool
 from band import logger, app
 
 
+# change constantly, not a reason to bump state version
+VOLATILE_KEYS = ('uptime', 'app_uptime')
+
+
+def stable(state):
+    """
+    State without volatile fields, for change detection
+    """
+    if not state:
+        return state
+    res = {k: v for k, v in state.items() if k not in VOLATILE_KEYS}
+    if res.get('replicas'):
+        res['replicas'] = [stable(r) for r in res['replicas']]
+    return res
+
+
+# config fields saved from service state
+CONFIG_FIELDS = ('pos', 'build_options', 'env')
+
+
+def rounded(value, digits=1):
+    return round(value, digits) if value is not None else None
+
+
 class MethodRegistration(pdict):
     method: str
     role: str
@@ -26,7 +49,14 @@ class ServiceDashPosition(pdict):
             return f"{self.col}x{self.row}"
 
 
-class ServiceState(pdict):
+class ServiceState:
+    __slots__ = (
+        '_meta', '_app', '_app_ts', '_dock', '_dock_ts', '_pos', '_build_options',
+        '_methods', '_name', '_title', '_managed', '_protected', '_persistent',
+        '_native', '_manager', '_env', '_status_override', '_stale', '_loaded',
+        '_version', '_visible', '_state_cache', '_state_cache_version', '_health',
+        '_config_extra')
+
     _meta: pdict
     _app: pdict
     _app_ts: int
@@ -42,20 +72,27 @@ class ServiceState(pdict):
     _persistent: bool
     _native: bool
 
-    def __init__(self, manager, name, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, manager, name):
         self._pos = ServiceDashPosition()
         self._manager = manager
+        # image meta outlives runtime status
+        self._meta = pdict()
         self._build_options = pdict()
         self._env = pdict()
-        self._logs = deque(maxlen=1000)
+        # stored config fields not managed by state, kept on save
+        self._config_extra = pdict()
         self._name = name
         self._title = name.replace('_', ' ').title()
+        self._loaded = False
+        self._version = 0
+        self._visible = (False, False)
+        self._state_cache = None
+        self._state_cache_version = None
+        self._health = None
         self.clean_status()
 
     def clean_status(self):
         logger.debug('restoring state', name=self.name)
-        self._meta = pdict()
         self._app = pdict()
         self._app_ts = None
         self._status_override = None
@@ -66,15 +103,61 @@ class ServiceState(pdict):
         self._protected = False
         self._persistent = False
         self._native = False
+        self._stale = False
+        # flags defined by image meta
+        self.apply_meta()
+        self._changed()
+
+    def _changed(self):
+        self._manager.touch(self)
+
+    @property
+    def version(self):
+        return self._version
+
+    def set_version(self, version):
+        self._version = version
+
+    def refresh_visibility(self):
+        """
+        Detects app/docker state expiration. Returns True if visibility changed
+        """
+        visible = (self.dockstate is not None, self.appstate is not None)
+        changed = visible != self._visible
+        self._visible = visible
+        return changed
+
+    def expires_at(self):
+        """
+        Nearest moment when visible state expires
+        """
+        deadlines = [ts + SERVICE_TIMEOUT for ts in (self._app_ts, self._dock_ts) if ts]
+        return min(deadlines) if deadlines else None
 
     @property
     def config(self):
         return pdict(
-            pos=self.pos, build_options=self.build_options, env=self._env)
+            **self._config_extra, pos=self.pos, build_options=self.build_options, env=self._env)
+
+    def set_config_extra(self, config):
+        self._config_extra = pdict(**{
+            k: v for k, v in (config or {}).items() if k not in CONFIG_FIELDS})
 
     def full_state(self):
+        """
+        Service state memoized by state version
+        """
+        if self.refresh_visibility():
+            self._changed()
+        if self._state_cache_version != self._version:
+            self._state_cache = self._build_state()
+            self._state_cache_version = self._version
+        return self._state_cache
+
+    def _build_state(self):
         docker = self.dockstate
         appdata = self.appstate
+        health = self._health or {}
         state = None
         uptime = None
         inband = False
@@ -96,21 +179,90 @@ class ServiceState(pdict):
             title=self.title,
             inband=inband,
             pos=self.pos,
+            # availability by status probes over last 24h, percents
+            sla=health.get('availability_24h'),
             # TODO: remove when dashboard updated
-            sla=randint(98, 99),
             mem=randint(1, 3),
             cpu=randint(1, 3),
             stat=dict(
-                sla=0,
+                sla=health.get('availability_24h') or 0,
                 mem=0,
                 cpu=0,
             ),
+            health=self._health,
+            stale=self._stale,
+            replicas=docker.get('replicas') if docker else None,
+            replicas_running=docker.get('replicas_running') if docker else None,
             meta=dict(
                 native=self._native,
                 managed=self._managed,
                 protected=self._protected,
                 persistent=self._persistent))
 
+    def snapshot(self):
+        """
+        Serializable state used to restore service after director restart
+        """
+        return dict(
+            title=self.title,
+            pos=dict(self.pos),
+            dock=self.dockstate,
+            app=self.appstate,
+            methods=self.methods,
+            managed=self._managed,
+            protected=self._protected,
+            persistent=self._persistent,
+            native=self._native)
+
+    def restore(self, snapshot):
+        """
+        Restore state from snapshot. Restored data marked stale until fresh data received
+        """
+        now = time()
+        self._title = snapshot.get('title') or self._title
+        pos = snapshot.get('pos') or {}
+        self.set_pos(pos.get('col'), pos.get('row'))
+        if snapshot.get('dock'):
+            self._dock = pdict.from_dict(snapshot['dock'])
+            self._dock_ts = now
+        if snapshot.get('app'):
+            self._app = pdict.from_dict(snapshot['app'])
+            self._app_ts = now
+        self._methods = snapshot.get('methods') or []
+        self._managed = snapshot.get('managed', False)
+        self._protected = snapshot.get('protected', False)
+        self._persistent = snapshot.get('persistent', False)
+        self._native = snapshot.get('native', False)
+        self._stale = True
+        self._changed()
+
+    @property
+    def health(self):
+        return self._health
+
+    def set_health(self, health):
+        """
+        Probe summary. State version bumped only on failures change
+        or availability change visible at one decimal
+        """
+        previous = self._health or {}
+        self._health = health
+        if previous.get('failures') != health.get('failures') or any(
+                rounded(previous.get(k)) != rounded(health.get(k))
+                for k in ('availability_1h', 'availability_24h')):
+            self._changed()
+
+    @property
+    def stale(self):
+        return self._stale
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def set_loaded(self):
+        self._loaded = True
+
     @property
     def methods(self):
         return self._methods
@@ -120,7 +272,9 @@ class ServiceState(pdict):
         return self._pos
 
     def set_title(self, title):
-        self._title = title
+        if title != self._title:
+            self._title = title
+            self._changed()
 
     @property
     def name(self):
@@ -138,6 +292,9 @@ class ServiceState(pdict):
         return bool(self.dockstate)
 
     def is_active(self):
+        # restored from snapshot, live only after fresh docker or app state
+        if self._stale:
+            return False
         ds = self.dockstate
         if ds and ds.state == STATUS_RUNNING:
             return True
@@ -158,6 +315,10 @@ class ServiceState(pdict):
 
         self._build_options.update(params)
 
+    def replace_build_opts(self, **params):
+        self._build_options = pdict()
+        self.set_build_opts(**params)
+
     @property
     def env(self):
         return self._env
@@ -167,8 +328,10 @@ class ServiceState(pdict):
 
     def set_pos(self, col, row):
         if col is not None and row is not None:
-            self._pos.col = col
-            self._pos.row = row
+            if (col, row) != (self._pos.col, self._pos.row):
+                self._pos.col = col
+                self._pos.row = row
+                self._changed()
 
     @property
     def meta(self):
@@ -183,12 +346,15 @@ class ServiceState(pdict):
 
     def apply_meta(self):
         if self.meta:
+            flags = (self._protected, self._persistent, self._native)
             if nn(self.meta.protected):
                 self._protected = self.meta.protected
             if nn(self.meta.persistent):
                 self._persistent = self.meta.persistent
             if nn(self.meta.native):
                 self._native = self.meta.native
+            if flags != (self._protected, self._persistent, self._native):
+                self._changed()
 
     def save_config(self):
         self._manager.save_config(self.name, self.config)
@@ -199,15 +365,15 @@ class ServiceState(pdict):
             return self._app
 
     def set_status_override(self, status):
-        self._status_override = status
+        if status != self._status_override:
+            self._status_override = status
+            self._changed()
 
     def set_status_starting(self):
-        self._status_override = STATUS_STARTING
-        pass
+        self.set_status_override(STATUS_STARTING)
 
     def set_status_removing(self):
-        self._status_override = STATUS_REMOVING
-        pass
+        self.set_status_override(STATUS_REMOVING)
 
     def set_methods(self, methods):
         if not methods:
@@ -220,10 +386,14 @@ class ServiceState(pdict):
 
     def set_appstate(self, appstate):
         if appstate:
+            changed = self._stale or stable(appstate) != stable(self._app) or not self.appstate
             self._app = appstate
             self._app_ts = time()
+            self._stale = False
             if 'register' in appstate:
                 self.set_methods(appstate['register'])
+            if changed:
+                self._changed()
 
     @property
     def dockstate(self):
@@ -232,11 +402,17 @@ class ServiceState(pdict):
 
     def set_dockstate(self, dockstate):
         if dockstate:
+            changed = (self._stale or stable(dockstate) != stable(self._dock)
+                       or self._status_override or not self._managed)
             self._dock = dockstate
             self._managed = True
             self._status_override = None
+            self._stale = False
 
             self.apply_meta()
             
             if dockstate.running == True:
+                changed = changed or not self.dockstate
                 self._dock_ts = time()
+            if changed:
+                self._changed()
@@ -0,0 +1,51 @@
+import os
+import ujson
+import aiofiles
+from band import logger
+
+from ..constants import SNAPSHOT_KEY, SNAPSHOT_FILE
+
+
+class RedisSnapshotStore:
+    """
+    Keeps director state snapshot in redis using band config storage
+    """
+
+    def __init__(self, band_config):
+        self.band_config = band_config
+
+    async def save(self, data):
+        await self.band_config.save_snapshot(SNAPSHOT_KEY, data)
+
+    async def load(self):
+        return await self.band_config.load_snapshot(SNAPSHOT_KEY)
+
+
+class FileSnapshotStore:
+    """
+    Keeps director state snapshot as json file at data dir
+    """
+
+    def __init__(self, data_dir):
+        self.path = os.path.join(data_dir, SNAPSHOT_FILE)
+
+    async def save(self, data):
+        tmp_path = f'{self.path}.tmp'
+        async with aiofiles.open(tmp_path, 'w') as f:
+            await f.write(ujson.dumps(data, ensure_ascii=False))
+        os.replace(tmp_path, self.path)
+
+    async def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            async with aiofiles.open(self.path) as f:
+                return ujson.loads(await f.read())
+        except ValueError:
+            logger.warn('broken state snapshot', path=self.path)
+
+
+def snapshot_store(band_config, snapshot_store='redis', data_dir=None, **kwargs):
+    if snapshot_store == 'file' and data_dir:
+        return FileSnapshotStore(data_dir)
+    return RedisSnapshotStore(band_config)
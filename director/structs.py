@@ -35,6 +35,7 @@ class ServicePostion(namedtuple('ServicePostion', 'col row')):
 class BuildOptions(Prodict):
     nocache: bool
     auto_remove: bool
+    replicas: int
 
 
 class RunParams(Prodict):
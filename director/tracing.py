@@ -0,0 +1,112 @@
+"""
+Lifecycle phases latency tracing
+"""
+from collections import deque
+from contextlib import contextmanager
+from time import perf_counter
+from band import logger, settings
+
+from .constants import LATENCY_SAMPLES, PENDING_SPAN_TTL
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+class LatencyHistogram:
+    """
+    Keeps last samples of phase duration
+    """
+    __slots__ = ('samples', 'count', 'max', 'over_budget')
+
+    def __init__(self, size=LATENCY_SAMPLES):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.max = 0
+        self.over_budget = 0
+
+    def add(self, duration):
+        self.samples.append(duration)
+        self.count += 1
+        if duration > self.max:
+            self.max = duration
+
+    def summary(self):
+        values = sorted(self.samples)
+        return dict(
+            count=self.count,
+            p50=percentile(values, 0.5),
+            p95=percentile(values, 0.95),
+            max=self.max,
+            last=self.samples[-1] if self.samples else None,
+            over_budget=self.over_budget)
+
+
+class Tracer:
+    """
+    Aggregates spans duration by service and phase.
+    Budgets is mapping phase name to allowed duration in seconds
+    """
+
+    def __init__(self, budgets=None):
+        self.budgets = budgets or {}
+        self.stats = dict()
+        self.pending = dict()
+
+    @contextmanager
+    def span(self, service, phase):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(service, phase, perf_counter() - started)
+
+    def record(self, service, phase, duration):
+        key = (service, phase)
+        hist = self.stats.get(key)
+        if not hist:
+            hist = self.stats[key] = LatencyHistogram()
+        hist.add(duration)
+        budget = self.budgets.get(phase)
+        if budget and duration > budget:
+            hist.over_budget += 1
+            logger.warn('phase exceeded budget', service=service, phase=phase,
+                        duration=round(duration, 3), budget=budget)
+
+    def begin(self, service, phase):
+        """
+        Starts span closed later from another place, by finish()
+        """
+        now = perf_counter()
+        self.expire(now)
+        self.pending[(service, phase)] = now
+
+    def expire(self, now=None):
+        """
+        Drops spans never finished, like alive of service crashed at start
+        """
+        deadline = (now or perf_counter()) - PENDING_SPAN_TTL
+        for key, started in list(self.pending.items()):
+            if started < deadline:
+                del self.pending[key]
+                logger.warn('span not finished', service=key[0], phase=key[1])
+
+    def finish(self, service, phase):
+        started = self.pending.pop((service, phase), None)
+        if started:
+            self.record(service, phase, perf_counter() - started)
+
+    def report(self, service=None):
+        self.expire()
+        result = dict()
+        for (svc, phase), hist in self.stats.items():
+            if service and svc != service:
+                continue
+            result.setdefault(svc, dict())[phase] = hist.summary()
+        return result
+
+
+tracer = Tracer(settings.get('deploy_budgets'))
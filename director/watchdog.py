@@ -0,0 +1,115 @@
+"""
+Event loop lag watchdog.
+Heartbeat coroutine measures loop lag, watcher thread captures stack
+of main thread when heartbeat late, so blocking code can be located.
+"""
+import asyncio
+import sys
+import threading
+import traceback
+from time import perf_counter, sleep, time
+from band import logger, settings
+
+
+def frame_stack(frame, limit=40):
+    return [f'{fs.filename}:{fs.lineno} {fs.name}'
+            for fs in traceback.extract_stack(frame, limit=limit)]
+
+
+class Offender:
+    __slots__ = ('stack', 'count', 'total_lag', 'max_lag', 'last_seen')
+
+    def __init__(self, stack):
+        self.stack = stack
+        self.count = 0
+        self.total_lag = 0
+        self.max_lag = 0
+        self.last_seen = None
+
+    def add(self, lag):
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+
+    def as_dict(self):
+        return dict(
+            count=self.count, total_lag=self.total_lag, max_lag=self.max_lag,
+            last_seen=self.last_seen, stack=self.stack)
+
+
+class LoopWatchdog:
+    def __init__(self, interval=0.1, threshold=0.25, table_size=50, **kwargs):
+        self.interval = interval
+        self.threshold = threshold
+        self.table_size = table_size
+        self.offenders = dict()
+        self.loop_thread_id = None
+        self.beat = perf_counter()
+        self.lag = 0
+        self.max_lag = 0
+        self.stalls = 0
+        self._stall_key = None
+        self._running = False
+
+    async def run(self):
+        """
+        Heartbeat. Should be started inside event loop
+        """
+        self.loop_thread_id = threading.get_ident()
+        self._running = True
+        thread = threading.Thread(target=self.watch, name='loop-watchdog', daemon=True)
+        thread.start()
+        try:
+            while True:
+                started = perf_counter()
+                await asyncio.sleep(self.interval)
+                self.beat = perf_counter()
+                self.lag = max(0, self.beat - started - self.interval)
+                self.max_lag = max(self.max_lag, self.lag)
+                if self._stall_key:
+                    offender = self.offenders.get(self._stall_key)
+                    if offender:
+                        offender.add(self.lag)
+                    self._stall_key = None
+        finally:
+            self._running = False
+
+    def stop(self):
+        self._running = False
+
+    def watch(self):
+        """
+        Watcher thread body
+        """
+        while self._running:
+            sleep(self.interval / 2)
+            late = perf_counter() - self.beat - self.interval
+            if late > self.threshold and not self._stall_key:
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame:
+                    self.capture(frame_stack(frame))
+
+    def capture(self, stack):
+        key = tuple(stack)
+        offender = self.offenders.get(key)
+        if not offender:
+            if len(self.offenders) >= self.table_size:
+                weakest = min(self.offenders, key=lambda k: self.offenders[k].total_lag)
+                del self.offenders[weakest]
+            offender = self.offenders[key] = Offender(stack)
+        offender.count += 1
+        offender.last_seen = time()
+        self.stalls += 1
+        self._stall_key = key
+        logger.warn('event loop blocked', at=stack[-1] if stack else None)
+
+    def report(self):
+        offenders = sorted(self.offenders.values(), key=lambda o: o.total_lag, reverse=True)
+        return dict(
+            lag=self.lag,
+            max_lag=self.max_lag,
+            stalls=self.stalls,
+            threshold=self.threshold,
+            offenders=[o.as_dict() for o in offenders])
+
+
+watchdog = LoopWatchdog(**(settings.get('loop_watchdog') or {}))
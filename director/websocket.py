@@ -9,12 +9,16 @@ from concurrent.futures import CancelledError
 import datetime
 from simplech import AsyncClickHouse
 from .structs import LogRecord
+from . import metrics
 
 ch = AsyncClickHouse()
 
 
-async def ws_sender(ws):
-    subscription = state.logs_reader()
+async def ws_sender(ws, subscription=None, notify=True):
+    """
+    Streams log records. notify - also pass records to logs service
+    """
+    subscription = subscription or state.logs_reader()
     while True:
         try:
             msg = await subscription.get()
@@ -33,7 +37,8 @@ async def ws_sender(ws):
                 'data': msg.message
             }
             await ws.send_str(ujson.dumps(data))
-            await rpc.notify('logs', 'write', msg=msg)
+            if notify:
+                await rpc.notify('logs', 'write', msg=msg)
         except CancelledError:
             logger.debug('ws writer closed')
             break
@@ -42,12 +47,41 @@ async def ws_sender(ws):
             break
 
 
+async def ws_state_sender(ws, since, epoch=None):
+    """
+    Streams services state diffs. Client resumes stream passing last received seq and epoch
+    """
+    subscription = state.state_reader(since, epoch)
+    try:
+        while True:
+            event = await subscription.get()
+            await ws.send_str(ujson.dumps(event))
+    except CancelledError:
+        logger.debug('ws state writer closed')
+    except Exception:
+        logger.exception('ex')
+    finally:
+        subscription.close()
+
+
 async def websocket_handler(request):
     ws = web.WebSocketResponse()
+    senders = []
+    # state stream enabled with ?since=<seq>&epoch=<epoch>, use 0 for fresh clients
+    since = request.query.get('since')
+    epoch = request.query.get('epoch')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return web.Response(status=400)
 
     try:
         await ws.prepare(request)
-        sender = await scheduler.spawn(ws_sender(ws))
+        metrics.ws_clients.inc()
+        senders.append(await scheduler.spawn(ws_sender(ws)))
+        if since is not None:
+            senders.append(await scheduler.spawn(ws_state_sender(ws, since, epoch)))
         async for msg in ws:
             if msg.type == aiohttp.WSMsgType.TEXT:
                 if msg.data == 'close':
@@ -67,7 +101,10 @@ async def websocket_handler(request):
     except Exception:
         logger.exception('ex')
     finally:
-        await sender.close()
+        if ws.prepared:
+            metrics.ws_clients.dec()
+        for sender in senders:
+            await sender.close()
 
     return ws
 